@@ -8,122 +8,2012 @@ Created on Fri Jul 10 09:53:57 2020
 import ast
 import atexit
 import collections
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
 import os.path
 import re
+import shutil
+import socket
+import sqlite3
+import stat
 import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 from configparser import ConfigParser
+from multiprocessing.connection import Connection
 from pathlib import Path
-from typing import IO, Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 try:
     import tomllib
 except ModuleNotFoundError:
     import tomli as tomllib  # type:ignore
 
+try:
+    import fcntl
+except ModuleNotFoundError:  # Windows
+    fcntl = None  # type:ignore
+
 from mypy import api as mypy_api
+from mypy.version import __version__ as mypy_version
 from pylsp import _utils, hookimpl
 from pylsp.config.config import Config
-from pylsp.workspace import Document, Workspace
+from pylsp.workspace import RE_START_WORD, Document, Workspace
+
+line_pattern = re.compile(
+    (
+        r"^(?P<file>.+):(?P<start_line>\d+):(?P<start_col>\d*):(?P<end_line>\d*):(?P<end_col>\d*): "
+        r"(?P<severity>\w+): (?P<message>.+?)(?: +\[(?P<code>.+)\])?$"
+    )
+)
+
+log = logging.getLogger(__name__)
+
+# A mapping from workspace path to config file path
+mypyConfigFileMap: Dict[str, Optional[str]] = {}
+
+settingsCache: Dict[str, Dict[str, Any]] = {}
+
+# Directory holding the shadow files of unsaved documents, created on first use
+shadowDir: Optional[str] = None
+# A mapping from document path to its shadow file and the hash of the source last written to it
+shadowFiles: Dict[str, Tuple[str, str]] = {}
+shadowLock = threading.Lock()
+# Overlay trees mirroring a workspace for the dmypy live mode, by workspace path
+overlayDirs: Dict[str, str] = {}
+# A mapping from document path to the hash of the unsaved source written into its overlay tree and
+# the mtime given to it
+overlayFiles: Dict[str, Tuple[str, int]] = {}
+
+# Status files of the dmypy daemons by workspace path and mypy config file, least recently used
+# first
+dmypyDaemons: "collections.OrderedDict[Tuple[str, Optional[str]], str]" = collections.OrderedDict()
+dmypyLock = threading.Lock()
+# The background check warming up each dmypy daemon by status file
+dmypyWarmUps: Dict[str, "Future[Optional[Tuple[str, str, int]]]"] = {}
+# Files saved since the last check of each dmypy daemon by status file
+dmypyChanges: Dict[str, Set[str]] = collections.defaultdict(set)
+# The fingerprint of the options of the last full run of each dmypy daemon by status file, when it
+# happened and whether the options allow targeted rechecks
+dmypyRuns: Dict[str, Tuple[str, float, bool]] = {}
+# Background refreshes of the fine-grained cache by workspace path, and the workspaces for which
+# another refresh was requested while one was running
+cacheRefreshes: Dict[str, "Future[Tuple[str, str, int]]"] = {}
+cacheRefreshPending: Set[str] = set()
+# When the next refresh of the fine-grained cache of each workspace path may start
+cacheRefreshDue: Dict[str, float] = {}
+# When each dmypy daemon by status file was last used and after how many idle seconds it stops
+dmypyLastUsed: Dict[str, Tuple[float, float]] = {}
+# The pid and connection name of each running dmypy daemon by status file, read from the status file
+# once
+dmypyConnections: Dict[str, Tuple[int, str]] = {}
+# Consecutive failures of each unavailable dmypy daemon by status file, when it may be tried again
+# and why it failed
+dmypyOutages: Dict[str, Tuple[int, float, str]] = {}
+# Status files of the daemons whose current outage was already reported
+reportedOutages: Set[str] = set()
+# Descriptors of the lock files held for the dmypy daemons this process owns, by status file
+dmypyOwned: Dict[str, int] = {}
+# When the type of an expression was last inspected with each dmypy daemon by status file
+dmypyHovers: Dict[str, float] = {}
+# The files each dmypy daemon by status file has the types of all expressions of, for inspecting
+dmypyTypedFiles: Dict[str, Set[str]] = {}
+# The hovers answered with each dmypy daemon by status file, by document URI: the document version
+# and source they are valid for and, for the first word of each, its span, where it starts and the
+# hover
+hoverCache: Dict[
+    str,
+    Dict[str, Tuple[Any, List[Tuple[Tuple[int, int, int, int], Tuple[int, int], Dict[str, Any]]]]],
+] = {}
+# The mypy options, without the checked files, each dmypy daemon by status file last checked with
+dmypyOptions: Dict[str, List[str]] = {}
+# The replacements being started for the dmypy daemons by status file whose options changed
+dmypyStandbys: Dict[str, "Future[None]"] = {}
+# Status files of the daemons being replaced because they grew past dmypy_max_rss
+dmypyRecycling: Set[str] = set()
+# Serializes the requests to each daemon by status file, the daemon answers one at a time anyway
+dmypyRequestLocks: Dict[str, threading.RLock] = collections.defaultdict(threading.RLock)
+
+# The diagnostics last returned for each document path
+last_diagnostics: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+
+# A mapping from document path to the other files the last check of it reported on
+relatedFiles: Dict[str, Set[str]] = {}
+
+# Moving average of how long a mypy run took, in seconds, per workspace path
+lintDurations: Dict[str, float] = {}
+# Number of lint requests received per document path, used to coalesce bursts of requests
+lintGenerations: Dict[str, int] = collections.defaultdict(int)
+lintLock = threading.Lock()
+
+# Diagnostics of previous checks keyed by a hash of the source, the mypy arguments and the mtime of
+# the mypy config file, least recently used first
+diagnosticsCache: "collections.OrderedDict[str, List[Dict[str, Any]]]" = collections.OrderedDict()
+cacheStats: Dict[str, int] = {"hits": 0, "misses": 0}
+cacheLock = threading.Lock()
+# The background check of the cached diagnostics last returned per document path
+revalidations: Dict[str, "Future[None]"] = {}
+# Connection to the on-disk diagnostics store, opened on first use
+persistentStore: Optional[sqlite3.Connection] = None
+
+# Idle mypy worker processes and their connections, for the "pool" executor
+idleWorkers: List[Tuple[multiprocessing.process.BaseProcess, Connection]] = []
+# Number of worker processes alive, idle or busy
+workerCount = 0
+workerCondition = threading.Condition()
+# The worker process currently checking each document path
+busyWorkers: Dict[str, multiprocessing.process.BaseProcess] = {}
+
+# The multiprocessing context forking mypy processes from a preloaded zygote, started on first use
+zygoteContext: Optional[multiprocessing.context.ForkServerContext] = None
+
+# Resident fine-grained build state per workspace path: the fingerprint of the mypy arguments it
+# was built with, its FineGrainedBuildManager and the FileSystemWatcher of its files
+fineGrainedEngines: Dict[str, Tuple[str, Any, Any]] = {}
+fineGrainedLock = threading.Lock()
+
+# Runs mypy checks in the background, at most one of them in flight per document
+lintExecutor = ThreadPoolExecutor(thread_name_prefix="pylsp_mypy")
+# The (document version, is_saved) key and the future of the latest check per document path
+inFlight: Dict[str, Tuple[Tuple[Optional[int], bool], "Future[List[Dict[str, Any]]]"]] = {}
+
+# Seconds to wait before starting a failed dmypy daemon again, doubled on every further failure
+DMYPY_BACKOFF_START = 1.0
+DMYPY_BACKOFF_MAX = 300.0
+# Seconds to wait for a dmypy daemon started by the process owning it
+DMYPY_OWNER_WAIT = 10.0
+# Seconds a hover waits for the dmypy daemon to answer
+DMYPY_HOVER_TIMEOUT = 10.0
+# How many hovers are kept per document
+HOVER_CACHE_SIZE = 256
+
+# Weight of the newest run in the moving average of run durations
+DEBOUNCE_SMOOTHING = 0.3
+# Fraction of the average run duration to wait for further edits before checking
+DEBOUNCE_FACTOR = 0.5
+
+
+def parse_line(line: str, document: Optional[Document] = None) -> Optional[Dict[str, Any]]:
+    """
+    Return a language-server diagnostic from a line of the Mypy error report.
+
+    optionally, use the whole document to provide more context on it.
+
+
+    Parameters
+    ----------
+    line : str
+        Line of mypy output to be analysed.
+    document : Optional[Document], optional
+        Document in wich the line is found. The default is None.
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        The dict with the lint data.
+
+    """
+    parsed = parse_report_line(line)
+    if not parsed:
+        return None
+
+    file_path, diagnostic = parsed
+    if file_path != "<string>":  # live mode
+        # results from other files can be included, but we cannot return
+        # them.
+        if document and document.path and not document.path.endswith(file_path):
+            log.warning("discarding result for %s against %s", file_path, document.path)
+            return None
+
+    return diagnostic
+
+
+def parse_report_line(line: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Return the file and the language-server diagnostic from a line of the Mypy error report.
+
+    Parameters
+    ----------
+    line : str
+        Line of mypy output to be analysed.
+
+    Returns
+    -------
+    Optional[Tuple[str, Dict[str, Any]]]
+        The file as reported by mypy and the dict with the lint data.
+
+    """
+    result = line_pattern.match(line)
+    if not result:
+        return None
+
+    lineno = int(result["start_line"]) - 1  # 0-based line number
+    offset = int(result["start_col"]) - 1  # 0-based offset
+    end_lineno = int(result["end_line"]) - 1
+    end_offset = int(result["end_col"])  # end is exclusive
+
+    severity = result["severity"]
+    if severity not in ("error", "note"):
+        log.warning(f"invalid error severity '{severity}'")
+    errno = 1 if severity == "error" else 3
+
+    return result["file"], {
+        "source": "mypy",
+        "range": {
+            "start": {"line": lineno, "character": offset},
+            "end": {"line": end_lineno, "character": end_offset},
+        },
+        "message": result["message"],
+        "severity": errno,
+        "code": result["code"],
+    }
+
+
+def apply_overrides(args: List[str], overrides: List[Any]) -> List[str]:
+    """Replace or combine default command-line options with overrides."""
+    overrides_iterator = iter(overrides)
+    if True not in overrides_iterator:
+        return overrides
+    # If True is in the list, the if above leaves the iterator at the element after True,
+    # therefore, the list below only contains the elements after the True
+    rest = list(overrides_iterator)
+    # slice of the True and the rest, add the args, add the rest
+    return overrides[: -(len(rest) + 1)] + args + rest
+
+
+def didSettingsChange(workspace: str, settings: Dict[str, Any]) -> None:
+    """Handle relevant changes to the settings between runs."""
+    configSubPaths = settings.get("config_sub_paths", [])
+    if settingsCache[workspace].get("config_sub_paths", []) != configSubPaths:
+        mypyConfigFile = findConfigFile(
+            workspace,
+            configSubPaths,
+            ["mypy.ini", ".mypy.ini", "pyproject.toml", "setup.cfg"],
+            True,
+        )
+        mypyConfigFileMap[workspace] = mypyConfigFile
+        settingsCache[workspace] = settings.copy()
+
+
+def record_duration(workspace: str, duration: float) -> None:
+    """Fold the duration of a mypy run into the moving average of its workspace."""
+    with lintLock:
+        average = lintDurations.get(workspace)
+        if average is None:
+            lintDurations[workspace] = duration
+        else:
+            lintDurations[workspace] = average + DEBOUNCE_SMOOTHING * (duration - average)
+
+
+def debounce(workspace: str, path: str, settings: Dict[str, Any]) -> bool:
+    """
+    Wait for a quiet period and report whether this lint request is still the latest one.
+
+    The quiet period is sized from the moving average of recent run durations in the workspace,
+    so that a burst of edits results in a single mypy run once typing pauses.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace the document belongs to.
+    path : str
+        The path of the document to be linted.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    Returns
+    -------
+    bool
+        False if a newer lint request for the same document arrived while waiting.
+
+    """
+    with lintLock:
+        lintGenerations[path] += 1
+        generation = lintGenerations[path]
+        delay = DEBOUNCE_FACTOR * lintDurations.get(workspace, 0.0)
+
+    delay = min(delay, settings.get("debounce_max_delay", 2.0))
+    if delay > 0:
+        log.debug("debouncing lint of %s for %.2fs", path, delay)
+        time.sleep(delay)
+
+    with lintLock:
+        return lintGenerations[path] == generation
+
+
+def schedule_check(
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    is_saved: bool,
+    lookup: bool = True,
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Check a document in the background and wait for the result.
+
+    Only one check per document is in flight at a time. Requests for the same document version
+    share a single check. A request for a newer version cancels the older check if it has not
+    started yet and otherwise waits for it to finish before starting. A request without lookup
+    neither shares nor cancels a check: it waits for a check of the same version to finish and is
+    dropped while a newer version is being checked.
+
+    Parameters
+    ----------
+    workspace : Workspace
+        The pylsp workspace.
+    document : Document
+        The document to be linted.
+    settings : Dict[str, Any]
+        The plugin settings.
+    is_saved : bool
+        Weather the document is saved.
+    lookup : bool, optional
+        Whether cached diagnostics may be returned, see get_diagnostics. The default is True.
+
+    Returns
+    -------
+    Optional[List[Dict[str, Any]]]
+        List of the linting data or None if the document changed while it was being checked.
+
+    """
+    path = document.path
+    version = document.version
+    key = (version, is_saved)
+
+    with lintLock:
+        previous = inFlight.get(path)
+        if previous and previous[0] == key and lookup:
+            future = previous[1]
+        elif previous and previous[0] != key and not lookup:
+            log.info("not checking %s version %s again, a newer check is pending", path, version)
+            return None
+        else:
+            if previous and previous[0] != key and not previous[1].cancel():
+                # A check running in a worker process can actually be stopped.
+                worker = busyWorkers.get(path)
+                if worker is not None:
+                    log.info("terminating superseded check of %s", path)
+                    worker.terminate()
+            future = lintExecutor.submit(
+                _run_check,
+                previous[1] if previous else None,
+                workspace,
+                document,
+                settings,
+                is_saved,
+                lookup,
+            )
+            inFlight[path] = (key, future)
+
+    try:
+        diagnostics = future.result()
+    except CancelledError:
+        log.info("check of %s version %s was cancelled", path, version)
+        return None
+    finally:
+        # Also after a failed check, so that the next request checks again.
+        with lintLock:
+            current = inFlight.get(path)
+            if current is not None and current[1] is future:
+                del inFlight[path]
+            # A later check of the same version, without lookup, does not outdate this one.
+            superseded = current is not None and current[0] != key
+
+    if superseded:
+        log.info("discarding result of %s version %s, a newer check is pending", path, version)
+        return None
+
+    if document.version != version:
+        log.info("discarding result of %s version %s, it is outdated", path, version)
+        return None
+    return diagnostics
+
+
+def _run_check(
+    previous: "Optional[Future[List[Dict[str, Any]]]]",
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    is_saved: bool,
+    lookup: bool,
+) -> List[Dict[str, Any]]:
+    """Wait for the superseded check of the document to finish and then run a new one."""
+    if previous is not None:
+        try:
+            previous.result()
+        except BaseException:
+            pass
+    return get_diagnostics(workspace, document, settings, is_saved, lookup)
+
+
+def get_shadow_file(document: Document, source: str) -> str:
+    """
+    Return the shadow file holding the unsaved source of a document for live mode.
+
+    Every document gets its own file, placed on a RAM-backed directory when one is available. The
+    file is only rewritten when the source changed since it was last written.
+
+    Parameters
+    ----------
+    document : Document
+        The document to be linted.
+    source : str
+        The unsaved source of the document.
+
+    Returns
+    -------
+    str
+        The path of the shadow file.
+
+    """
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    with shadowLock:
+        entry = shadowFiles.get(document.path)
+        if entry and entry[1] == digest:
+            return entry[0]
+
+        if entry:
+            name = entry[0]
+        else:
+            prefix = hashlib.sha256(document.path.encode("utf-8")).hexdigest()[:16]
+            name = os.path.join(get_shadow_dir(), f"{prefix}-{os.path.basename(document.path)}")
+        with open(name, "w", encoding="utf-8") as file:
+            file.write(source)
+        shadowFiles[document.path] = (name, digest)
+        return name
+
+
+def get_shadow_dir() -> str:
+    """Return the directory for shadow files and overlay trees, creating it if needed."""
+    global shadowDir
+    if shadowDir is None:
+        ramDir = "/dev/shm"
+        base = ramDir if os.path.isdir(ramDir) and os.access(ramDir, os.W_OK) else None
+        shadowDir = tempfile.mkdtemp(prefix="pylsp-mypy-", dir=base)
+        log.info("live_mode shadowDir = %s", shadowDir)
+    return shadowDir
+
+
+def prune_shadow_files(workspace: Workspace) -> None:
+    """Remove the shadow files of documents in the workspace that are no longer open."""
+    openPaths = {document.path for document in workspace.documents.values()}
+    root = os.path.join(workspace.root_path, "")
+    with shadowLock:
+        for path in list(shadowFiles):
+            if path.startswith(root) and path not in openPaths:
+                name, _ = shadowFiles.pop(path)
+                log.info("removing shadow file %s of closed document %s", name, path)
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+
+        overlay = overlayDirs.get(workspace.root_path)
+        for path in list(overlayFiles):
+            if overlay and path.startswith(root) and path not in openPaths:
+                del overlayFiles[path]
+                log.info("restoring overlay link of closed document %s", path)
+                target = os.path.join(overlay, os.path.relpath(path, workspace.root_path))
+                try:
+                    os.unlink(target)
+                    os.symlink(path, target)
+                except OSError:
+                    pass
+
+
+def mirror_directory(real: str, mirror: str) -> None:
+    """Link every entry of a directory into its mirror that is not in there yet."""
+    try:
+        names = os.listdir(real)
+    except OSError:
+        return
+    for name in names:
+        target = os.path.join(mirror, name)
+        if not os.path.lexists(target):
+            os.symlink(os.path.join(real, name), target)
+
+
+def get_overlay_path(workspace: str, path: str, source: Optional[str]) -> str:
+    """
+    Return the path of a file in the overlay tree of its workspace, bringing it up to date.
+
+    The overlay tree mirrors the workspace with symbolic links, so the mypy daemon sees changes on
+    disk as usual. Only the directories on the way to checked files are real directories, which
+    allows writing the unsaved source of a document in place of the link to the file.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace.
+    path : str
+        The path of the file to be checked.
+    source : Optional[str]
+        The unsaved source of the file, or None to check the file on disk.
+
+    Returns
+    -------
+    str
+        The path of the file in the overlay tree, or path itself if it is outside the workspace.
+
+    """
+    relative = os.path.relpath(path, workspace)
+    if relative.startswith(os.pardir):
+        return path
+
+    with shadowLock:
+        overlay = get_overlay_dir(workspace)
+        parts = relative.split(os.sep)
+        real, mirror = workspace, overlay
+        for part in parts[:-1]:
+            mirror_directory(real, mirror)
+            real, mirror = os.path.join(real, part), os.path.join(mirror, part)
+            if os.path.islink(mirror):
+                os.unlink(mirror)
+            if not os.path.isdir(mirror):
+                os.mkdir(mirror)
+        mirror_directory(real, mirror)
+
+        target = os.path.join(mirror, parts[-1])
+        if source is None:
+            if overlayFiles.pop(path, None) is not None or not os.path.lexists(target):
+                if os.path.lexists(target):
+                    os.unlink(target)
+                os.symlink(path, target)
+        else:
+            digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+            previous = overlayFiles.get(path)
+            if previous is None or previous[0] != digest:
+                if previous is not None:
+                    last = previous[1]
+                else:
+                    try:
+                        last = os.stat(path).st_mtime_ns
+                    except OSError:
+                        last = 0
+                if os.path.islink(target):
+                    os.unlink(target)
+                with open(target, "w", encoding="utf-8") as file:
+                    file.write(source)
+                # The fswatcher of dmypy only compares the size and the whole seconds of the mtime,
+                # so a rewrite of the same size within a second would go unnoticed.
+                mtime = max(os.stat(target).st_mtime_ns, last + 1_000_000_000)
+                os.utime(target, ns=(mtime, mtime))
+                overlayFiles[path] = (digest, mtime)
+        return target
+
+
+def get_overlay_dir(workspace: str) -> str:
+    """Return the overlay tree of a workspace, creating it if needed."""
+    overlay = overlayDirs.get(workspace)
+    if overlay is None:
+        overlay = tempfile.mkdtemp(prefix="overlay-", dir=get_shadow_dir())
+        overlayDirs[workspace] = overlay
+        log.info("dmypy overlay = %s for %s", overlay, workspace)
+    return overlay
+
+
+def from_overlay(workspace: str, path: str) -> str:
+    """Map a path mypy reported in the overlay tree of a workspace back to the workspace."""
+    overlay = overlayDirs.get(workspace)
+    if overlay:
+        absolute = os.path.abspath(path)
+        if absolute.startswith(os.path.join(overlay, "")):
+            return os.path.join(workspace, os.path.relpath(absolute, overlay))
+    return path
+
+
+def to_overlay(workspace: str, path: str) -> str:
+    """Map a path in a workspace to its overlay tree, if the workspace has one."""
+    overlay = overlayDirs.get(workspace)
+    relative = os.path.relpath(path, workspace)
+    if overlay and not relative.startswith(os.pardir):
+        return os.path.join(overlay, relative)
+    return path
+
+
+def run_in_memory(args: List[str], unsaved: Dict[str, str]) -> Tuple[str, str, int]:
+    """
+    Run mypy through mypy.build, handing the unsaved source of documents over in memory.
+
+    This avoids writing a shadow file that mypy reads back for every check in live mode.
+
+    Parameters
+    ----------
+    args : List[str]
+        The mypy command-line arguments, which must include the paths of the documents.
+    unsaved : Dict[str, str]
+        The unsaved sources of the documents to be linted, by path.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run.
+
+    """
+    # Imported lazily like mypy.api does, to keep the server startup fast
+    from mypy import build
+    from mypy.errors import CompileError
+    from mypy.fscache import FileSystemCache
+    from mypy.main import process_options
+
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    fscache = FileSystemCache()
+    try:
+        sources, options = process_options(args, stdout=stdout, stderr=stderr, fscache=fscache)
+    except SystemExit as e:
+        return stdout.getvalue(), stderr.getvalue(), e.code if isinstance(e.code, int) else 2
+
+    for source in sources:
+        if source.path and os.path.abspath(source.path) in unsaved:
+            source.text = unsaved[os.path.abspath(source.path)]
+    # The native parser of newer mypy versions reads files by path and ignores supplied text.
+    if getattr(options, "native_parser", False):
+        options.native_parser = False
+
+    messages: List[str] = []
+
+    def flush_errors(filename: Optional[str], newMessages: List[str], serious: bool) -> None:
+        messages.extend(newMessages)
+        (stderr if serious else stdout).writelines(message + "\n" for message in newMessages)
+
+    blockers = False
+    try:
+        result = build.build(sources, options, None, flush_errors, fscache, stdout, stderr)
+        # Only the metadata stores of mypy 1.20 and later can be closed.
+        close = getattr(result.manager.metastore, "close", None)
+        if close is not None:
+            close()
+    except CompileError:
+        blockers = True
+
+    exit_status = 0
+    if any(": error:" in message for message in messages):
+        exit_status = 2 if blockers else 1
+    return stdout.getvalue(), stderr.getvalue(), exit_status
+
+
+def _worker_main(connection: Connection) -> None:
+    """Run mypy for every argument vector received over the connection until it is closed."""
+    # Import everything a check needs up front, so that the first check does not pay for it
+    import mypy.build  # noqa: F401
+    import mypy.main  # noqa: F401
+    from mypy import api
+
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            return
+        result = api.run(args)
+        connection.send((result, read_rss("self")))
+
+
+def read_rss(pid: str) -> int:
+    """Return the resident memory of a process in bytes, or 0 where it cannot be read."""
+    pageSize = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 0
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * pageSize
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def acquire_worker(size: int) -> Tuple[multiprocessing.process.BaseProcess, Connection]:
+    """Take an idle worker process from the pool or start one if the pool is not full yet."""
+    global workerCount
+    with workerCondition:
+        while True:
+            while idleWorkers:
+                process, connection = idleWorkers.pop()
+                if process.is_alive():
+                    return process, connection
+                connection.close()
+                workerCount -= 1
+            if workerCount < size:
+                workerCount += 1
+                break
+            workerCondition.wait()
+
+    try:
+        context = multiprocessing.get_context("spawn")
+        connection, child = context.Pipe()
+        process = context.Process(
+            target=_worker_main, args=(child,), name="pylsp_mypy worker", daemon=True
+        )
+        process.start()
+        child.close()
+    except BaseException:
+        release_worker(None)
+        raise
+    log.info("started mypy worker process %s", process.pid)
+    return process, connection
+
+
+def release_worker(
+    worker: Optional[Tuple[multiprocessing.process.BaseProcess, Connection]]
+) -> None:
+    """Return a worker process to the pool, or account for one that was retired if None."""
+    global workerCount
+    with workerCondition:
+        if worker is None:
+            workerCount -= 1
+        else:
+            idleWorkers.append(worker)
+        workerCondition.notify()
+
+
+def run_in_worker(args: List[str], path: str, settings: Dict[str, Any]) -> Tuple[str, str, int]:
+    """
+    Run mypy in one of the long-lived worker processes of the pool.
+
+    This keeps the pylsp process responsive while mypy runs. Workers whose memory grew past the
+    configured limit are retired after their run and a crashing mypy only takes a worker down.
+
+    Parameters
+    ----------
+    args : List[str]
+        The mypy command-line arguments.
+    path : str
+        The path of the document that is checked.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run.
+
+    """
+    worker = acquire_worker(max(1, settings.get("worker_processes", 2)))
+    process, connection = worker
+    with lintLock:
+        busyWorkers[path] = process
+    try:
+        connection.send(args)
+        (report, errors, exit_status), rss = connection.recv()
+    except (EOFError, OSError):
+        connection.close()
+        process.join(1)
+        release_worker(None)
+        log.warning("mypy worker process %s died, exit code %s", process.pid, process.exitcode)
+        return "", f"mypy worker process died with exit code {process.exitcode}", 2
+    finally:
+        with lintLock:
+            if busyWorkers.get(path) is process:
+                del busyWorkers[path]
+
+    if rss > settings.get("worker_max_rss", 2048) * 1024 * 1024:
+        log.info("retiring mypy worker process %s using %s bytes", process.pid, rss)
+        connection.close()
+        process.join(5)
+        release_worker(None)
+    else:
+        release_worker(worker)
+    return report, errors, exit_status
+
+
+def _zygote_main(connection: Connection, args: List[str]) -> None:
+    """Run mypy once in a process forked from the zygote and send back the result."""
+    from mypy import api
+
+    connection.send(api.run(args))
+    connection.close()
+
+
+def get_zygote_context() -> Optional[multiprocessing.context.ForkServerContext]:
+    """
+    Return the context forking mypy processes from the zygote, starting the zygote if needed.
+
+    The zygote is the multiprocessing fork server with this module and mypy preloaded, so a
+    forked process starts from a warm interpreter. It is not available on Windows.
+
+    """
+    global zygoteContext
+    if zygoteContext is None:
+        if "forkserver" not in multiprocessing.get_all_start_methods():
+            return None
+        from multiprocessing import forkserver
+
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__, "mypy.api", "mypy.build", "mypy.main"])
+        forkserver.ensure_running()
+        log.info("started mypy zygote process")
+        zygoteContext = context
+    return zygoteContext
+
+
+def run_in_zygote(args: List[str], path: str) -> Tuple[str, str, int]:
+    """
+    Run mypy in a process forked from the preloaded zygote.
+
+    Parameters
+    ----------
+    args : List[str]
+        The mypy command-line arguments.
+    path : str
+        The path of the document that is checked.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run.
+
+    """
+    context = get_zygote_context()
+    if context is None:
+        log.info("no zygote on this platform, executing mypy via api")
+        return mypy_api.run(args)
+
+    connection, child = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_zygote_main, args=(child, args), name="pylsp_mypy check", daemon=True
+    )
+    process.start()
+    child.close()
+    with lintLock:
+        busyWorkers[path] = process
+    try:
+        return connection.recv()
+    except EOFError:
+        process.join()
+        log.warning("mypy process %s died, exit code %s", process.pid, process.exitcode)
+        return "", f"mypy process died with exit code {process.exitcode}", 2
+    finally:
+        with lintLock:
+            if busyWorkers.get(path) is process:
+                del busyWorkers[path]
+        connection.close()
+        process.join()
+
+
+def run_fine_grained(
+    workspace: str, args: List[str], optionArgs: List[str]
+) -> Tuple[str, str, int]:
+    """
+    Check files with a fine-grained incremental build kept resident in this process.
+
+    The first check of a workspace builds the whole program like the mypy daemon does. Later checks
+    only reprocess the requested files, files changed on disk and whatever depends on them. Unsaved
+    sources are taken from the shadow files among the arguments.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace.
+    args : List[str]
+        The mypy command-line arguments.
+    optionArgs : List[str]
+        The arguments without the checked files and shadow files. The build is started over when
+        they change.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run.
+
+    """
+    # Imported lazily like mypy.api does, to keep the server startup fast
+    from mypy import build
+    from mypy.errors import CompileError
+    from mypy.fscache import FileSystemCache
+    from mypy.fswatcher import FileSystemWatcher
+    from mypy.main import process_options
+    from mypy.server.update import FineGrainedBuildManager
+
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    fingerprint = hashlib.sha256("\0".join(optionArgs).encode("utf-8")).hexdigest()
+
+    with fineGrainedLock:
+        engine = fineGrainedEngines.get(workspace)
+        if engine and engine[0] != fingerprint:
+            log.info("mypy options changed, starting over the fine-grained build of %s", workspace)
+            engine = None
+            del fineGrainedEngines[workspace]
+
+        fscache = engine[1].manager.fscache if engine else FileSystemCache()
+        fscache.flush()
+        try:
+            sources, options = process_options(args, stdout=stdout, stderr=stderr, fscache=fscache)
+        except SystemExit as e:
+            return stdout.getvalue(), stderr.getvalue(), e.code if isinstance(e.code, int) else 2
+
+        try:
+            if engine is None:
+                # The same adjustments the daemon makes for fine-grained incremental mode
+                options.incremental = True
+                options.fine_grained_incremental = True
+                options.cache_dir = os.devnull
+                options.local_partial_types = True
+                if hasattr(options, "num_workers"):
+                    options.num_workers = 0
+                if options.follow_imports == "silent":
+                    options.follow_imports = "normal"
+
+                result = build.build(sources, options, fscache=fscache)
+                manager = FineGrainedBuildManager(result)
+                watcher = FileSystemWatcher(fscache)
+                watcher.add_watched_paths(
+                    [state.path for state in manager.graph.values() if state.path]
+                )
+                watcher.find_changed()
+                manager.flush_cache()
+                fineGrainedEngines[workspace] = (fingerprint, manager, watcher)
+                messages = result.errors
+            else:
+                _, manager, watcher = engine
+                manager.manager.shadow_map = dict(options.shadow_file or [])
+                manager.manager.shadow_equivalence_map.clear()
+
+                modules = {state.path: state.id for state in manager.graph.values() if state.path}
+                changed = [(source.module, source.path) for source in sources if source.path]
+                removed = []
+                for path in watcher.find_changed():
+                    if path not in modules:
+                        continue
+                    if fscache.isfile(path):
+                        changed.append((modules[path], path))
+                    else:
+                        removed.append((modules[path], path))
+                        watcher.remove_watched_paths([path])
+
+                messages = manager.update(changed, removed)
+                manager.flush_cache()
+                watcher.add_watched_paths(
+                    [state.path for state in manager.graph.values() if state.path]
+                )
+        except CompileError as e:
+            # A blocking error leaves the build in an unusable state, start over next time.
+            fineGrainedEngines.pop(workspace, None)
+            return "", "".join(message + "\n" for message in e.messages), 2
+
+    exit_status = 1 if any(": error:" in message for message in messages) else 0
+    return "".join(message + "\n" for message in messages), stderr.getvalue(), exit_status
+
+
+def get_status_file(workspace: str, settings: Dict[str, Any]) -> str:
+    """
+    Return the status file of the dmypy daemon for a workspace and its mypy config file.
+
+    Every distinct configuration gets a daemon of its own, so switching between projects does not
+    restart a daemon with different options. When more than ``dmypy_max_daemons`` are in use, the
+    least recently used daemon is stopped.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    Returns
+    -------
+    str
+        The path of the status file to pass to dmypy.
+
+    """
+    key = (workspace, mypyConfigFileMap.get(workspace))
+    evicted = []
+    with dmypyLock:
+        statusFile = dmypyDaemons.get(key)
+        if statusFile is None:
+            configured = settings.get("dmypy_status_file")
+            if configured:
+                statusFile = os.path.join(workspace, os.path.expanduser(configured))
+            else:
+                statusFile = default_status_file(*key)
+            if not os.path.exists(statusFile) and os.path.exists(standby_status_file(statusFile)):
+                statusFile = standby_status_file(statusFile)
+            dmypyDaemons[key] = statusFile
+            log.info("dmypy status file = %s for %s", statusFile, key)
+            check_stale_daemon(statusFile)
+        elif statusFile not in dmypyStandbys and not os.path.exists(statusFile):
+            # Another process may have replaced the daemon by its standby.
+            standby = standby_status_file(statusFile)
+            if os.path.exists(standby):
+                log.info("following dmypy daemon of %s to %s", key, standby)
+                statusFile = dmypyDaemons[key] = standby
+        dmypyDaemons.move_to_end(key)
+        while len(dmypyDaemons) > max(1, settings.get("dmypy_max_daemons", 4)):
+            evicted.append(dmypyDaemons.popitem(last=False))
+
+    for evictedKey, evictedFile in evicted:
+        log.info("stopping least recently used dmypy daemon of %s", evictedKey)
+        stop_daemon(evictedFile)
+    return statusFile
+
+
+def default_status_file(workspace: str, configFile: Optional[str]) -> str:
+    """
+    Return the status file of the dmypy daemon for a workspace and mypy config file.
+
+    The name only depends on them, so a restarted pylsp finds the daemon it started before. It is
+    placed in ``$XDG_RUNTIME_DIR`` or, if unset, in a directory of the user in the temp directory.
+    Should that directory be accessible to others, the daemons of this process are kept in its
+    shadow directory instead, see get_shadow_dir.
+
+    """
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimeDir:
+        directory = os.path.join(runtimeDir, "pylsp-mypy")
+    else:
+        user = os.getuid() if hasattr(os, "getuid") else os.getlogin()
+        directory = os.path.join(tempfile.gettempdir(), f"pylsp-mypy-{user}")
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError as e:
+        log.warning("cannot create %s: %s", directory, e)
+    if not is_private_dir(directory):
+        # Anyone who can write there could point us at their socket, or at files to remove.
+        log.warning("not using %s for dmypy status files, it is not private", directory)
+        directory = get_shadow_dir()
+    digest = hashlib.sha256(f"{workspace}\0{configFile or ''}".encode("utf-8")).hexdigest()
+    return os.path.join(directory, f"{digest[:16]}.dmypy.json")
+
+
+def is_private_dir(path: str) -> bool:
+    """Return whether a path is a directory, not a link, only the current user has access to."""
+    if not hasattr(os, "getuid"):
+        return os.path.isdir(path)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+    )
+
+
+def standby_status_file(statusFile: str) -> str:
+    """
+    Return the status file of the other of the two daemons a workspace may have.
+
+    A replacement of a daemon is started under the other status file, and the two swap roles once
+    it is ready, see start_standby.
+
+    """
+    base, ext = os.path.splitext(statusFile)
+    if base.endswith(".standby"):
+        return base[: -len(".standby")] + ext
+    return base + ".standby" + ext
+
+
+def check_stale_daemon(statusFile: str) -> None:
+    """Remove what a dead dmypy daemon left behind, or log that a live one will be reused."""
+    from mypy.dmypy_os import alive
+
+    try:
+        with open(statusFile) as file:
+            pid = int(json.load(file)["pid"])
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError):
+        pid = None
+
+    if pid is not None and alive(pid):
+        log.info("reusing running dmypy daemon %s of %s", pid, statusFile)
+    else:
+        log.info("removing stale dmypy status file %s", statusFile)
+        remove_daemon_files(statusFile)
+
+
+def remove_daemon_files(statusFile: str) -> None:
+    """
+    Remove a dmypy status file and the socket named in it.
+
+    The daemon creates its socket in a private directory of its own, which is removed with it. A
+    socket anywhere else is left alone, as the status file may name any path.
+
+    """
+    try:
+        with open(statusFile, "rb") as fp:
+            sock = json.load(fp).get("connection_name")
+    except (OSError, ValueError, AttributeError):
+        sock = None
+
+    if isinstance(sock, str) and os.path.isabs(sock) and is_private_dir(os.path.dirname(sock)):
+        try:
+            if stat.S_ISSOCK(os.lstat(sock).st_mode):
+                os.unlink(sock)
+                os.rmdir(os.path.dirname(sock))
+        except OSError:
+            pass
+    elif sock:
+        log.warning("not removing dmypy socket %s outside of a private directory", sock)
+
+    try:
+        os.unlink(statusFile)
+    except OSError:
+        pass
+
+
+def touch_daemon(statusFile: str, settings: Dict[str, Any]) -> None:
+    """
+    Record the use of a dmypy daemon, which stops by itself once it was idle for long enough.
+
+    Daemons are started with ``dmypy_idle_timeout`` as their own timeout. Unlike a timer in this
+    process, that counts the requests of every pylsp process sharing the daemon. A stopped daemon
+    is started again by the next check that needs it.
+
+    Parameters
+    ----------
+    statusFile : str
+        The status file of the daemon.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    """
+    timeout = settings.get("dmypy_idle_timeout", 900)
+    with dmypyLock:
+        if timeout <= 0:
+            dmypyLastUsed.pop(statusFile, None)
+            return
+        dmypyLastUsed[statusFile] = (time.monotonic(), timeout)
+
+
+def claim_daemon(statusFile: str) -> bool:
+    """
+    Try to become the owner of the dmypy daemon of a status file, return whether this process is.
+
+    Owning a daemon is holding a lock on a file next to its status file. Only the owner starts,
+    restarts and stops the daemon, other pylsp processes on the same project use it as clients.
+    The lock is released when the owner exits, so the next process that needs to start or stop the
+    daemon takes over. The lock is a POSIX record lock, which the forked daemon does not inherit.
+    Without ``fcntl`` every process acts as the owner.
+
+    """
+    if fcntl is None:
+        return True
+    with dmypyLock:
+        if statusFile in dmypyOwned:
+            return True
+        try:
+            fd = os.open(statusFile + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            log.warning("cannot open dmypy lock file of %s: %s", statusFile, e)
+            return True
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        dmypyOwned[statusFile] = fd
+    log.info("owning dmypy daemon %s", statusFile)
+    return True
+
+
+def release_daemon(statusFile: str) -> None:
+    """Give up the ownership of the dmypy daemon of a status file, if this process has it."""
+    with dmypyLock:
+        fd = dmypyOwned.pop(statusFile, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def stop_daemon(statusFile: str) -> None:
+    """Stop the dmypy daemon of a status file and remove what it leaves behind, if it is ours."""
+    dmypyConnections.pop(statusFile, None)
+    dmypyWarmUps.pop(statusFile, None)
+    dmypyRuns.pop(statusFile, None)
+    dmypyTypedFiles.pop(statusFile, None)
+    dmypyOptions.pop(statusFile, None)
+    hoverCache.pop(statusFile, None)
+    if not os.path.exists(statusFile):
+        return
+    if not claim_daemon(statusFile):
+        log.info("not stopping dmypy daemon %s, another process owns it", statusFile)
+        return
+
+    mypy_api.run_dmypy(["--status-file", statusFile, "stop"])
+
+    if os.path.exists(statusFile):
+        remove_daemon_files(statusFile)
+    release_daemon(statusFile)
+
+
+class DmypyError(Exception):
+    """A dmypy daemon could not be started, died or did not answer in time."""
+
+
+def dmypy_request(
+    statusFile: str, command: str, timeout: Optional[float] = None, **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Send a request to a running dmypy daemon and return its response.
+
+    Unlike mypy_api.run_dmypy this does not parse a command line, capture the output or read the
+    status file again for every request. The daemon serves a single request per connection, so
+    each request still connects to the socket named in the status file.
+
+    Parameters
+    ----------
+    statusFile : str
+        The status file of the daemon.
+    command : str
+        The daemon command, like ``run`` or ``inspect``.
+    timeout : Optional[float], optional
+        Seconds to wait for the daemon at most, or None to wait indefinitely. The default is None.
+    **kwargs : Any
+        The arguments of the command.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The response, with an ``error`` entry if the daemon could not be reached, a ``hung``
+        entry if it did not answer in time and a ``busy`` entry if other requests to it did not
+        finish in time.
+
+    """
+    # Imported lazily like mypy.api does, to keep the server startup fast
+    from mypy.dmypy_os import alive
+    from mypy.dmypy_util import receive, send
+    from mypy.ipc import IPCClient, IPCException
+
+    request = dict(kwargs, command=command, is_tty=False, terminal_width=80)
+    response: Dict[str, Any] = {}
+    # The daemon may be replaced while waiting for the lock, only look at it once holding it.
+    # Waiting for the requests of others counts against the deadline as well.
+    lock = dmypyRequestLocks[statusFile]
+    if not lock.acquire(timeout=-1 if timeout is None else timeout):
+        return {"error": f"dmypy daemon {statusFile} was busy for {timeout}s", "busy": True}
+    try:
+        connection = dmypyConnections.get(statusFile)
+        if connection is None:
+            try:
+                with open(statusFile) as file:
+                    data = json.load(file)
+                connection = (int(data["pid"]), str(data["connection_name"]))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                return {"error": f"cannot read dmypy status file {statusFile}: {e}"}
+            dmypyConnections[statusFile] = connection
+
+        pid, name = connection
+        if not alive(pid):
+            dmypyConnections.pop(statusFile, None)
+            return {"error": f"dmypy daemon {pid} has died"}
+
+        try:
+            with IPCClient(name, timeout) as client:
+                send(client, request)
+                # Output the daemon itself prints is streamed ahead of the final response.
+                while not response.get("final", False):
+                    response = receive(client)
+        # Before Python 3.10 socket.timeout is not yet an alias of TimeoutError.
+        except (TimeoutError, socket.timeout):
+            return {"error": f"dmypy daemon {pid} did not answer within {timeout}s", "hung": True}
+        except (OSError, IPCException) as e:
+            dmypyConnections.pop(statusFile, None)
+            return {"error": str(e)}
+    finally:
+        lock.release()
+    return response
+
+
+def kill_daemon(statusFile: str) -> None:
+    """Kill the dmypy daemon of a status file, which does not answer, and clean up after it."""
+    from mypy.dmypy_os import kill
+
+    if not claim_daemon(statusFile):
+        log.warning("dmypy daemon %s does not answer, leaving it to its owner", statusFile)
+        dmypyConnections.pop(statusFile, None)
+        return
+
+    connection = dmypyConnections.get(statusFile)
+    if connection is not None:
+        log.warning("killing unresponsive dmypy daemon %s", connection[0])
+        try:
+            kill(connection[0])
+        except Exception as e:
+            log.warning("killing dmypy daemon %s failed: %s", connection[0], e)
+    stop_daemon(statusFile)
+
+
+def run_dmypy(
+    statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> Tuple[str, str, int]:
+    """
+    Check files with the dmypy daemon of a status file, starting or restarting it as needed.
+
+    A daemon that does not answer in time is killed and started again, but the first check of a
+    newly started daemon is waited for without a timeout. Daemons are started with
+    ``dmypy_idle_timeout`` as their own timeout, so they shut down when nothing uses them, also
+    after pylsp exited. Types are only exported while hovering is in use, see exports_types.
+
+    When the options changed, a daemon that checked before keeps answering with its previous
+    options while a replacement starts in the background, see start_standby. Until the swap its
+    results are stale, see is_stale.
+
+    Parameters
+    ----------
+    statusFile : str
+        The status file of the daemon.
+    args : List[str]
+        The mypy command-line arguments.
+    paths : List[str]
+        The files to be checked among the arguments.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run_dmypy.
+
+    Raises
+    ------
+    DmypyError
+        If the daemon could not be started or did not answer the check.
+
+    """
+    from mypy.version import __version__
+
+    timeout = settings.get("dmypy_timeout", 300.0) or None
+    idleTimeout = settings.get("dmypy_idle_timeout", 900)
+    exportTypes = exports_types(statusFile, settings)
+    request = {"version": __version__, "args": args, "export_types": exportTypes}
+    response = dmypy_request(statusFile, "run", timeout, **request)
+    if response.get("busy"):
+        raise DmypyError(response["error"])
+    deadline = time.monotonic() + DMYPY_OWNER_WAIT
+    while ("error" in response or "restart" in response) and not claim_daemon(statusFile):
+        # Another process owns the daemon, it may be starting it right now.
+        if "restart" in response:
+            raise DmypyError(
+                f"the dmypy daemon {statusFile} is owned by another process using other options"
+            )
+        if response.get("hung") or response.get("busy") or time.monotonic() > deadline:
+            raise DmypyError(response["error"])
+        time.sleep(0.5)
+        response = dmypy_request(statusFile, "run", timeout, **request)
+
+    optionArgs = [arg for arg in args if arg not in paths]
+    staleArgs = dmypyOptions.get(statusFile)
+    if "restart" in response and staleArgs is not None and settings.get("dmypy_standby", True):
+        log.info(
+            "dmypy daemon needs a restart, checking with it meanwhile: %s", response["restart"]
+        )
+        start_standby(statusFile, args, paths, settings)
+        response = dmypy_request(
+            statusFile, "run", timeout, **dict(request, args=staleArgs + paths)
+        )
+        if response.get("busy"):
+            raise DmypyError(response["error"])
+        optionArgs = staleArgs
+
+    if "error" in response or "restart" in response:
+        log.info("dmypy daemon needs a (re)start: %s", response.get("error") or response["restart"])
+        if response.get("hung"):
+            kill_daemon(statusFile)
+        # A daemon that stopped when idle took its state along.
+        dmypyConnections.pop(statusFile, None)
+        dmypyTypedFiles.pop(statusFile, None)
+        hoverCache.pop(statusFile, None)
+        optionArgs = [arg for arg in args if arg not in paths]
+        start = ["--status-file", statusFile, "restart"]
+        if idleTimeout > 0:
+            start.extend(["--timeout", str(max(1, int(idleTimeout)))])
+        report, errors, exit_status = mypy_api.run_dmypy(start + ["--"] + optionArgs)
+        if exit_status != 0:
+            raise DmypyError(f"starting dmypy failed: {errors or report}".strip())
+        # The first check of a new daemon checks everything from scratch, which may take much
+        # longer than the incremental checks the timeout is meant for.
+        response = dmypy_request(statusFile, "run", None, **request)
+
+    if "error" in response:
+        if response.get("hung"):
+            kill_daemon(statusFile)
+        raise DmypyError(response["error"])
+    dmypyOptions[statusFile] = optionArgs
+    record_typed_files(statusFile, paths, exportTypes)
+    return response.get("out", ""), response.get("err", ""), response.get("status", 2)
+
+
+def start_standby(
+    statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> None:
+    """
+    Start a replacement of a dmypy daemon with new options in the background, unless one is.
+
+    Parameters
+    ----------
+    statusFile : str
+        The status file of the daemon to be replaced.
+    args : List[str]
+        The new mypy command-line arguments.
+    paths : List[str]
+        The files to be checked among the arguments.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    """
+    with dmypyLock:
+        if statusFile in dmypyStandbys:
+            return
+        dmypyStandbys[statusFile] = lintExecutor.submit(
+            _start_standby, statusFile, args, paths, settings
+        )
+
+
+def _start_standby(
+    statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> None:
+    """
+    Start a daemon under the standby status file, then swap it in for the daemon it replaces.
+
+    The swap only happens once the new daemon finished its initial check, so checks and hovers do
+    not wait for it. The replaced daemon is stopped afterwards. If the new daemon cannot be
+    started, the next check restarts the old one in place.
+
+    """
+    standby = standby_status_file(statusFile)
+    try:
+        if not claim_daemon(standby):
+            raise DmypyError(f"another process owns the dmypy daemon {standby}")
+        # A leftover of an earlier replacement, it has other options anyway.
+        stop_daemon(standby)
+        claim_daemon(standby)
+        log.info("starting dmypy standby %s for %s", standby, statusFile)
+        run_dmypy(standby, args, paths, settings)
+    except DmypyError as e:
+        log.warning("starting a dmypy standby for %s failed: %s", statusFile, e)
+        stop_daemon(standby)
+        with dmypyLock:
+            dmypyOptions.pop(statusFile, None)
+            dmypyStandbys.pop(statusFile, None)
+        return
+
+    with dmypyLock:
+        for key, daemon in dmypyDaemons.items():
+            if daemon == statusFile:
+                dmypyDaemons[key] = standby
+        if statusFile in dmypyLastUsed:
+            dmypyLastUsed[standby] = dmypyLastUsed.pop(statusFile)
+        if statusFile in dmypyHovers:
+            dmypyHovers[standby] = dmypyHovers.pop(statusFile)
+        dmypyChanges.pop(statusFile, None)
+        dmypyStandbys.pop(statusFile, None)
+    log.info("swapped dmypy daemon %s for %s", statusFile, standby)
+
+    # Not in the middle of a request to it
+    with dmypyRequestLocks[statusFile]:
+        stop_daemon(statusFile)
+
+
+def is_stale(statusFile: str) -> bool:
+    """Return whether a dmypy daemon checks with outdated options until its standby is ready."""
+    with dmypyLock:
+        return statusFile in dmypyStandbys
+
+
+def exports_types(statusFile: str, settings: Dict[str, Any]) -> bool:
+    """
+    Return whether a check with a dmypy daemon should export the types of all expressions.
+
+    Exporting types makes the daemon recheck every checked file completely and keep the types of
+    all of their expressions in memory, which only hovering needs. Types are exported once the
+    daemon was hovered with, until no hover happened for ``dmypy_hover_idle_timeout`` seconds.
+
+    """
+    with dmypyLock:
+        hovered = dmypyHovers.get(statusFile)
+    idleTimeout = settings.get("dmypy_hover_idle_timeout", 300)
+    return hovered is not None and time.monotonic() - hovered < idleTimeout
+
+
+def record_typed_files(statusFile: str, paths: List[str], exportTypes: bool) -> None:
+    """Record which files a dmypy daemon has the types of after a check of some files."""
+    with dmypyLock:
+        # A check may change types in any file.
+        hoverCache.pop(statusFile, None)
+        if exportTypes:
+            dmypyTypedFiles.setdefault(statusFile, set()).update(paths)
+        else:
+            # Whatever the check rechecked dropped its types, which is not known exactly.
+            dmypyTypedFiles.pop(statusFile, None)
+
+
+def recheck_dmypy(
+    workspace: str, statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> Optional[Tuple[str, str, int]]:
+    """
+    Check files with the dmypy daemon, telling it which files changed where possible.
+
+    ``dmypy run`` makes the daemon stat and hash every file of the build to find the changes. When
+    the options allow it, a recheck instead passes the checked files and the files saved since the
+    last check, so nothing else is looked at. A full run is still done when the options change and
+    every ``dmypy_full_run_interval`` seconds, to pick up changes made outside of the editor.
 
-line_pattern = re.compile(
-    (
-        r"^(?P<file>.+):(?P<start_line>\d+):(?P<start_col>\d*):(?P<end_line>\d*):(?P<end_col>\d*): "
-        r"(?P<severity>\w+): (?P<message>.+?)(?: +\[(?P<code>.+)\])?$"
+    Every request has a deadline of ``dmypy_timeout`` seconds. When the daemon cannot be started or
+    does not answer, it is tried again after a delay that doubles with every further failure.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace.
+    statusFile : str
+        The status file of the daemon.
+    args : List[str]
+        The mypy command-line arguments.
+    paths : List[str]
+        The files to be checked among the arguments.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    Returns
+    -------
+    Optional[Tuple[str, str, int]]
+        The report, the errors and the exit status, like mypy_api.run_dmypy, or None while the
+        daemon is unavailable.
+
+    """
+    with dmypyLock:
+        outage = dmypyOutages.get(statusFile)
+    if outage and time.monotonic() < outage[1]:
+        log.info("dmypy daemon %s is unavailable, not checking: %s", statusFile, outage[2])
+        return None
+
+    try:
+        result = _recheck_dmypy(workspace, statusFile, args, paths, settings)
+    except DmypyError as e:
+        failures = outage[0] + 1 if outage else 1
+        delay = min(DMYPY_BACKOFF_MAX, DMYPY_BACKOFF_START * 2 ** (failures - 1))
+        log.warning(
+            "dmypy daemon %s failed %s times, retrying in %ss: %s", statusFile, failures, delay, e
+        )
+        with dmypyLock:
+            dmypyOutages[statusFile] = (failures, time.monotonic() + delay, str(e))
+        return None
+
+    if outage:
+        log.info("dmypy daemon %s is available again", statusFile)
+        with dmypyLock:
+            dmypyOutages.pop(statusFile, None)
+            reportedOutages.discard(statusFile)
+
+    connection = dmypyConnections.get(statusFile)
+    limit = settings.get("dmypy_max_rss", 0)
+    if connection is not None and limit > 0:
+        rss = read_rss(str(connection[0]))
+        if rss > limit * 1024 * 1024 and claim_daemon(statusFile):
+            with dmypyLock:
+                if statusFile in dmypyRecycling:
+                    return result
+                dmypyRecycling.add(statusFile)
+            log.info("dmypy daemon %s uses %s bytes, replacing it", connection[0], rss)
+            lintExecutor.submit(recycle_daemon, statusFile, args, paths, settings)
+    return result
+
+
+def recycle_daemon(
+    statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> None:
+    """
+    Replace a dmypy daemon by a fresh one that repeated the last check.
+
+    Requests to the daemon wait until the new one is ready instead of failing. The new daemon
+    starts from the fine-grained cache if ``dmypy_fine_grained_cache`` is enabled.
+
+    Parameters
+    ----------
+    statusFile : str
+        The status file of the daemon.
+    args : List[str]
+        The mypy command-line arguments of the last check.
+    paths : List[str]
+        The files checked among the arguments.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    """
+    try:
+        with dmypyRequestLocks[statusFile]:
+            stop_daemon(statusFile)
+            run_dmypy(statusFile, args, paths, settings)
+    except DmypyError as e:
+        log.warning("replacing dmypy daemon %s failed: %s", statusFile, e)
+    finally:
+        with dmypyLock:
+            dmypyRecycling.discard(statusFile)
+
+
+def _recheck_dmypy(
+    workspace: str, statusFile: str, args: List[str], paths: List[str], settings: Dict[str, Any]
+) -> Tuple[str, str, int]:
+    """Do the check of recheck_dmypy, raising DmypyError if the daemon is unavailable."""
+    timeout = settings.get("dmypy_timeout", 300.0) or None
+    optionArgs = [arg for arg in args if arg not in paths]
+    fingerprint = hashlib.sha256("\0".join(optionArgs).encode("utf-8")).hexdigest()
+    with dmypyLock:
+        changes = dmypyChanges.pop(statusFile, set())
+
+    last = dmypyRuns.get(statusFile)
+    interval = settings.get("dmypy_full_run_interval", 60.0)
+    if last is None or last[0] != fingerprint or time.monotonic() - last[1] > interval:
+        report, errors, exit_status = run_dmypy(statusFile, args, paths, settings)
+        if exit_status != 2 and not is_stale(statusFile):
+            dmypyRuns[statusFile] = (fingerprint, time.monotonic(), allows_recheck(optionArgs))
+        return report, errors, exit_status
+    if not last[2]:
+        return run_dmypy(statusFile, args, paths, settings)
+
+    if settings.get("dmypy_live_mode", False):
+        changes = {to_overlay(workspace, path) for path in changes}
+    changes.update(paths)
+    update = sorted(path for path in changes if os.path.exists(path))
+    remove = sorted(path for path in changes if not os.path.exists(path))
+    log.info("dmypy recheck update = %s remove = %s", update, remove)
+    exportTypes = exports_types(statusFile, settings)
+    response = dmypy_request(
+        statusFile, "recheck", timeout, export_types=exportTypes, update=update, remove=remove
     )
-)
+    if response.get("busy"):
+        raise DmypyError(response["error"])
+    if "error" in response:
+        log.info("dmypy recheck failed, running instead: %s", response["error"])
+        if response.get("hung"):
+            kill_daemon(statusFile)
+        dmypyRuns.pop(statusFile, None)
+        return run_dmypy(statusFile, args, paths, settings)
+    record_typed_files(statusFile, paths, exportTypes)
+    return response.get("out", ""), response.get("err", ""), response.get("status", 2)
+
+
+def report_outage(statusFile: str) -> Optional[str]:
+    """Return why a dmypy daemon is unavailable, only the first time for each outage."""
+    with dmypyLock:
+        outage = dmypyOutages.get(statusFile)
+        if outage is None or statusFile in reportedOutages:
+            return None
+        reportedOutages.add(statusFile)
+        return outage[2]
 
-log = logging.getLogger(__name__)
 
-# A mapping from workspace path to config file path
-mypyConfigFileMap: Dict[str, Optional[str]] = {}
+def allows_recheck(optionArgs: List[str]) -> bool:
+    """
+    Return whether the daemon accepts targeted rechecks with the given mypy options.
 
-settingsCache: Dict[str, Dict[str, Any]] = {}
+    The daemon only takes lists of changed files when it does not follow imports.
+
+    """
+    # Imported lazily like mypy.api does, to keep the server startup fast
+    from mypy.main import process_options
 
-tmpFile: Optional[IO[str]] = None
-statusFile: str = tempfile.mktemp(".dmypy.json")
+    try:
+        _, options = process_options(
+            optionArgs, require_targets=False, stdout=io.StringIO(), stderr=io.StringIO()
+        )
+    except SystemExit:
+        return False
+    return options.follow_imports in ("skip", "error")
 
 
-def parse_line(line: str, document: Optional[Document] = None) -> Optional[Dict[str, Any]]:
+def daemon_args(workspace: str, settings: Dict[str, Any]) -> Tuple[List[str], str]:
     """
-    Return a language-server diagnostic from a line of the Mypy error report.
+    Return the mypy arguments checking the whole workspace with its dmypy daemon, and the target.
 
-    optionally, use the whole document to provide more context on it.
+    The options are the ones a check of a single document uses, so the daemon is not restarted.
+    With ``dmypy_live_mode`` the target is the overlay tree of the workspace.
+
+    """
+    target = workspace
+    if settings.get("dmypy_live_mode", False):
+        with shadowLock:
+            target = get_overlay_dir(workspace)
+            mirror_directory(workspace, target)
+
+    args = ["--show-error-end", "--no-error-summary"]
+    mypyConfigFile = mypyConfigFileMap.get(workspace)
+    if mypyConfigFile:
+        args.append("--config-file")
+        args.append(mypyConfigFile)
+    args.append(target)
+    if settings.get("strict", False):
+        args.append("--strict")
+    if settings.get("dmypy_fine_grained_cache", False):
+        args.append("--use-fine-grained-cache")
+    return apply_overrides(args, settings.get("overrides", [True])), target
+
+
+def warm_up_daemon(workspace: str, settings: Dict[str, Any]) -> None:
+    """
+    Start the dmypy daemon of a workspace and check the whole workspace in the background.
 
+    The daemon is started with the options a check of a single document uses, so that the first
+    lint finds it warm instead of paying for starting it and for the initial check.
 
     Parameters
     ----------
-    line : str
-        Line of mypy output to be analysed.
-    document : Optional[Document], optional
-        Document in wich the line is found. The default is None.
+    workspace : str
+        The path of the workspace.
+    settings : Dict[str, Any]
+        The plugin settings.
+
+    """
+    statusFile = get_status_file(workspace, settings)
+    touch_daemon(statusFile, settings)
+    with dmypyLock:
+        if statusFile in dmypyWarmUps or os.path.exists(statusFile):
+            return
+
+        args, target = daemon_args(workspace, settings)
+        log.info("warming up dmypy daemon of %s with args = %s", workspace, args)
+        dmypyWarmUps[statusFile] = lintExecutor.submit(
+            recheck_dmypy, workspace, statusFile, args, [target], settings
+        )
+
+
+def refresh_fine_grained_cache(
+    workspace: str, settings: Dict[str, Any], delay: float = 0.0
+) -> None:
+    """
+    Bring the fine-grained cache of a workspace up to date in the background.
+
+    A daemon started with ``--use-fine-grained-cache`` loads its state from this cache instead of
+    analysing the whole program again. mypy runs in a worker process of the pool, so the full
+    check does not hold up the pylsp process. Only one refresh per workspace runs at a time, a
+    request arriving meanwhile runs another one once it finished. Every request postpones the
+    refresh to ``delay`` seconds from now, so a series of saves results in a single refresh.
+
+    Parameters
+    ----------
+    workspace : str
+        The path of the workspace.
+    settings : Dict[str, Any]
+        The plugin settings.
+    delay : float, optional
+        Seconds to wait before refreshing. The default is 0.0.
+
+    """
+    statusFile = get_status_file(workspace, settings)
+    with dmypyLock:
+        cacheRefreshDue[workspace] = time.monotonic() + delay
+        running = cacheRefreshes.get(workspace)
+        if running is not None and not running.done():
+            cacheRefreshPending.add(workspace)
+            return
+
+        args, _ = daemon_args(workspace, settings)
+        args = [arg for arg in args if arg != "--use-fine-grained-cache"]
+        args.append("--cache-fine-grained")
+        cacheRefreshes[workspace] = lintExecutor.submit(
+            _refresh_cache, workspace, statusFile, args, settings
+        )
+
+
+def _refresh_cache(
+    workspace: str, statusFile: str, args: List[str], settings: Dict[str, Any]
+) -> Tuple[str, str, int]:
+    """Run mypy writing the fine-grained cache until no further refresh was requested."""
+    # Do not write the cache while the daemon is loading it.
+    wait_for_warm_up(statusFile)
+    while True:
+        with dmypyLock:
+            wait = cacheRefreshDue.get(workspace, 0.0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+        log.info("refreshing fine-grained cache of %s with args = %s", workspace, args)
+        result = run_in_worker(args, workspace, settings)
+        with dmypyLock:
+            if workspace not in cacheRefreshPending:
+                return result
+            cacheRefreshPending.discard(workspace)
+
+
+def wait_for_warm_up(statusFile: str) -> None:
+    """Wait for the warm-up of the dmypy daemon of a status file, if it is still running."""
+    warmUp = dmypyWarmUps.get(statusFile)
+    if warmUp is None:
+        return
+    if not warmUp.done():
+        log.info("waiting for the warm-up of dmypy daemon %s", statusFile)
+    try:
+        warmUp.result()
+    except Exception as e:
+        log.warning("warming up dmypy daemon %s failed: %s", statusFile, e)
+
+
+def diagnostics_cache_key(
+    source: str, args: List[str], configFile: Optional[str], ignoredArgs: List[str]
+) -> str:
+    """
+    Return the key under which the diagnostics of a check are cached.
+
+    Besides the arguments, the key covers the mypy version, so that results of an older mypy are
+    not returned after an upgrade.
+
+    Parameters
+    ----------
+    source : str
+        The source of the checked document.
+    args : List[str]
+        The arguments passed to mypy or dmypy.
+    configFile : Optional[str]
+        The mypy config file used for the check.
+    ignoredArgs : List[str]
+        Names of temporary files and directories among the arguments, like the live mode shadow
+        files and the dmypy overlay tree. They differ between processes without affecting the
+        result of the check and are left out of the key. Of paths inside such a directory, the
+        part relative to it is kept.
 
     Returns
     -------
-    Optional[Dict[str, Any]]
-        The dict with the lint data.
+    str
+        The hex digest identifying the check.
 
     """
-    result = line_pattern.match(line)
-    if not result:
-        return None
-
-    file_path = result["file"]
-    if file_path != "<string>":  # live mode
-        # results from other files can be included, but we cannot return
-        # them.
-        if document and document.path and not document.path.endswith(file_path):
-            log.warning("discarding result for %s against %s", file_path, document.path)
+    digest = hashlib.sha256(source.encode("utf-8"))
+    digest.update(b"\0" + mypy_version.encode("utf-8"))
+    for arg in args:
+        for ignored in ignoredArgs:
+            if arg == ignored:
+                arg = "<ignored>"
+            elif arg.startswith(os.path.join(ignored, "")):
+                arg = os.path.join("<ignored>", os.path.relpath(arg, ignored))
+        digest.update(b"\0")
+        digest.update(arg.encode("utf-8"))
+    if configFile:
+        try:
+            digest.update(b"\0%d" % os.stat(configFile).st_mtime_ns)
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def get_persistent_store() -> Optional[sqlite3.Connection]:
+    """Open the on-disk diagnostics store shared by all pylsp-mypy processes of the user."""
+    global persistentStore
+    if persistentStore is None:
+        cacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        path = os.path.join(cacheHome, "pylsp-mypy", "diagnostics.sqlite3")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+            store.execute("PRAGMA journal_mode=WAL")
+            store.execute(
+                "CREATE TABLE IF NOT EXISTS diagnostics "
+                "(key TEXT PRIMARY KEY, diagnostics TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            store.execute(
+                "CREATE INDEX IF NOT EXISTS diagnostics_accessed ON diagnostics (accessed)"
+            )
+            store.commit()
+        except (OSError, sqlite3.Error) as e:
+            log.warning("cannot open persistent cache %s: %s", path, e)
             return None
+        log.info("persistent cache = %s", path)
+        persistentStore = store
+    return persistentStore
 
-    lineno = int(result["start_line"]) - 1  # 0-based line number
-    offset = int(result["start_col"]) - 1  # 0-based offset
-    end_lineno = int(result["end_line"]) - 1
-    end_offset = int(result["end_col"])  # end is exclusive
 
-    severity = result["severity"]
-    if severity not in ("error", "note"):
-        log.warning(f"invalid error severity '{severity}'")
-    errno = 1 if severity == "error" else 3
+def get_cached_diagnostics(key: str, settings: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Return the cached diagnostics for the key, if any, and count the hit or miss.
 
-    return {
-        "source": "mypy",
-        "range": {
-            "start": {"line": lineno, "character": offset},
-            "end": {"line": end_lineno, "character": end_offset},
-        },
-        "message": result["message"],
-        "severity": errno,
-        "code": result["code"],
-    }
+    The in-memory cache is consulted first, then the persistent store if it is enabled.
+
+    """
+    with cacheLock:
+        diagnostics = diagnosticsCache.get(key)
+        if diagnostics is not None:
+            cacheStats["hits"] += 1
+            diagnosticsCache.move_to_end(key)
+            return list(diagnostics)
+
+        store = get_persistent_store() if settings.get("persistent_cache", False) else None
+        if store is not None:
+            try:
+                with store:
+                    row = store.execute(
+                        "SELECT diagnostics FROM diagnostics WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row:
+                        store.execute(
+                            "UPDATE diagnostics SET accessed = ? WHERE key = ?", (time.time(), key)
+                        )
+            except sqlite3.Error as e:
+                log.warning("reading persistent cache failed: %s", e)
+                row = None
+            if row:
+                cacheStats["hits"] += 1
+                diagnostics = json.loads(row[0])
+                if settings.get("cache_size", 128) > 0:
+                    diagnosticsCache[key] = list(diagnostics)
+                return diagnostics
+
+        cacheStats["misses"] += 1
+        return None
 
 
-def apply_overrides(args: List[str], overrides: List[Any]) -> List[str]:
-    """Replace or combine default command-line options with overrides."""
-    overrides_iterator = iter(overrides)
-    if True not in overrides_iterator:
-        return overrides
-    # If True is in the list, the if above leaves the iterator at the element after True,
-    # therefore, the list below only contains the elements after the True
-    rest = list(overrides_iterator)
-    # slice of the True and the rest, add the args, add the rest
-    return overrides[: -(len(rest) + 1)] + args + rest
+def cache_diagnostics(
+    key: str, diagnostics: List[Dict[str, Any]], settings: Dict[str, Any]
+) -> None:
+    """Store diagnostics in the enabled caches, evicting the least recently used entries."""
+    with cacheLock:
+        size = settings.get("cache_size", 128)
+        if size > 0:
+            diagnosticsCache[key] = list(diagnostics)
+            diagnosticsCache.move_to_end(key)
+            while len(diagnosticsCache) > size:
+                diagnosticsCache.popitem(last=False)
+
+        store = get_persistent_store() if settings.get("persistent_cache", False) else None
+        if store is not None:
+            try:
+                with store:
+                    store.execute(
+                        "INSERT OR REPLACE INTO diagnostics VALUES (?, ?, ?)",
+                        (key, json.dumps(diagnostics), time.time()),
+                    )
+                    store.execute(
+                        "DELETE FROM diagnostics WHERE key IN (SELECT key FROM diagnostics "
+                        "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                        (settings.get("persistent_cache_size", 10000),),
+                    )
+            except sqlite3.Error as e:
+                log.warning("writing persistent cache failed: %s", e)
+
+
+def revalidate_diagnostics(
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    is_saved: bool,
+    cached: List[Dict[str, Any]],
+) -> None:
+    """
+    Check a document whose diagnostics were taken from the cache again in the background.
 
+    The cache key only covers the document itself, the files it imports may have changed since.
+    The check is scheduled like a lint, see schedule_check. If it finds other diagnostics, they
+    replace the cached ones and are returned by the next lint of the document. They are not
+    published, as that would replace the diagnostics of the other linters too.
 
-def didSettingsChange(workspace: str, settings: Dict[str, Any]) -> None:
-    """Handle relevant changes to the settings between runs."""
-    configSubPaths = settings.get("config_sub_paths", [])
-    if settingsCache[workspace].get("config_sub_paths", []) != configSubPaths:
-        mypyConfigFile = findConfigFile(
-            workspace,
-            configSubPaths,
-            ["mypy.ini", ".mypy.ini", "pyproject.toml", "setup.cfg"],
-            True,
+    Parameters
+    ----------
+    workspace : Workspace
+        The pylsp workspace.
+    document : Document
+        The document that was linted.
+    settings : Dict[str, Any]
+        The plugin settings.
+    is_saved : bool
+        Weather the document is saved.
+    cached : List[Dict[str, Any]]
+        The cached diagnostics that were returned.
+
+    """
+    with cacheLock:
+        running = revalidations.get(document.path)
+        if running is not None and not running.done():
+            return
+        revalidations[document.path] = lintExecutor.submit(
+            _revalidate, workspace, document, settings, is_saved, cached
         )
-        mypyConfigFileMap[workspace] = mypyConfigFile
-        settingsCache[workspace] = settings.copy()
+
+
+def _revalidate(
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    is_saved: bool,
+    cached: List[Dict[str, Any]],
+) -> None:
+    """Do the check of revalidate_diagnostics and keep its result if it differs."""
+    try:
+        diagnostics = schedule_check(workspace, document, settings, is_saved, lookup=False)
+    except Exception:
+        log.exception("checking cached diagnostics of %s again failed", document.path)
+        return
+    if diagnostics is not None and diagnostics != cached:
+        log.info("cached diagnostics of %s were outdated", document.path)
+        last_diagnostics[document.path] = diagnostics
 
 
 @hookimpl
@@ -165,11 +2055,22 @@ def pylsp_lint(
 
     didSettingsChange(workspace.root_path, settings)
 
+    if not is_saved and settings.get("debounce", True):
+        if not debounce(workspace.root_path, document.path, settings):
+            log.info("lint of %s superseded by a newer request", document.path)
+            return last_diagnostics[document.path]
+
     if settings.get("report_progress", True):
         with workspace.report_progress("lint: mypy"):
-            return get_diagnostics(workspace, document, settings, is_saved)
+            diagnostics = schedule_check(workspace, document, settings, is_saved)
     else:
-        return get_diagnostics(workspace, document, settings, is_saved)
+        diagnostics = schedule_check(workspace, document, settings, is_saved)
+
+    if diagnostics is None:
+        return last_diagnostics[document.path]
+
+    last_diagnostics[document.path] = diagnostics
+    return diagnostics
 
 
 def get_diagnostics(
@@ -177,6 +2078,7 @@ def get_diagnostics(
     document: Document,
     settings: Dict[str, Any],
     is_saved: bool,
+    lookup: bool = True,
 ) -> List[Dict[str, Any]]:
     """
     Lints.
@@ -189,6 +2091,9 @@ def get_diagnostics(
         The document to be linted.
     is_saved : bool
         Weather the document is saved.
+    lookup : bool, optional
+        Whether cached diagnostics may be returned. The result is cached either way. The default
+        is True.
 
     Returns
     -------
@@ -207,47 +2112,201 @@ def get_diagnostics(
 
     args = ["--show-error-end", "--no-error-summary"]
 
-    global tmpFile
-    if not is_saved:
-        if tmpFile:
-            tmpFile = open(tmpFile.name, "w", encoding="utf-8")
-        else:
-            tmpFile = tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8")
-        log.info("live_mode tmpFile = %s", tmpFile.name)
-        tmpFile.write(document.source)
-        tmpFile.close()
-        args.extend(["--shadow-file", document.path, tmpFile.name])
+    prune_shadow_files(workspace)
+    batch = [document]
+    if not dmypy and settings.get("batch_dirty", False):
+        batch = sorted(batch + dirty_documents(workspace, document), key=lambda d: d.path)
+    # Read once, so that the shadow files, the cache key and the check agree on the source.
+    sources = {d.path: d.source for d in batch}
+    unsaved = {d.path: sources[d.path] for d in batch if d is not document or not is_saved}
+
+    shadows = []
+    inMemory = not dmypy and settings.get("in_memory", False)
+    overlay = dmypy and settings.get("dmypy_live_mode", False)
+    if not inMemory and not dmypy:
+        for d in batch:
+            if d.path not in unsaved:
+                continue
+            shadowFile = get_shadow_file(d, unsaved[d.path])
+            log.info("live_mode shadowFile = %s for %s", shadowFile, d.path)
+            args.extend(["--shadow-file", d.path, shadowFile])
+            shadows.append(shadowFile)
 
     mypyConfigFile = mypyConfigFileMap.get(workspace.root_path)
     if mypyConfigFile:
         args.append("--config-file")
         args.append(mypyConfigFile)
 
-    args.append(document.path)
+    paths = [d.path for d in batch]
+    if overlay:
+        try:
+            source = unsaved.get(document.path)
+            paths = [get_overlay_path(workspace.root_path, document.path, source)]
+        except OSError as e:
+            log.warning("cannot mirror %s into the dmypy overlay: %s", document.path, e)
+    args.extend(paths)
 
     if settings.get("strict", False):
         args.append("--strict")
+    if dmypy and settings.get("dmypy_fine_grained_cache", False):
+        args.append("--use-fine-grained-cache")
 
     overrides = settings.get("overrides", [True])
-    exit_status = 0
 
     if not dmypy:
         args.extend(["--incremental", "--follow-imports", "silent"])
-        args = apply_overrides(args, overrides)
-
-        log.info("executing mypy args = %s via api", args)
-        report, errors, exit_status = mypy_api.run(args)
-    else:
-        args = ["--status-file", statusFile, "run", "--export-types", "--"] + apply_overrides(
-            args, overrides
+    args = apply_overrides(args, overrides)
+
+    # Every document of a batch is cached under its own key, so that linting the others next
+    # finds their results. The overlay tree has a random name, like the shadow files.
+    overlayDir = overlayDirs.get(workspace.root_path) if overlay else None
+    cacheKeys = {
+        d.path: diagnostics_cache_key(
+            "\0".join([sources[d.path]] + [sources[o.path] for o in batch if o is not d]),
+            ["dmypy"] + args if dmypy else args,
+            mypyConfigFile,
+            shadows + ([overlayDir] if overlayDir else []),
         )
-
-        log.info("dmypy run args = %s via api", args)
-        report, errors, exit_status = mypy_api.run_dmypy(args)
+        for d in batch
+    }
+    useCache = settings.get("cache_size", 128) > 0 or settings.get("persistent_cache", False)
+    if useCache and lookup:
+        cached = get_cached_diagnostics(cacheKeys[document.path], settings)
+        if cached is not None:
+            log.info("pylsp-mypy cache hit, len(diagnostics) = %s", len(cached))
+            revalidate_diagnostics(workspace, document, settings, is_saved, cached)
+            return cached
+
+    start = time.monotonic()
+    result, cacheable = execute_check(
+        workspace, document, settings, args, batch, unsaved, shadows, paths
+    )
+    if result is None:
+        return last_diagnostics[document.path]
+    report, errors, _ = result
+    record_duration(workspace.root_path, time.monotonic() - start)
 
     log.debug("report:\n%s", report)
     log.debug("errors:\n%s", errors)
 
+    # Failed runs may succeed when retried, only cache regular reports.
+    cacheKeys = cacheKeys if useCache and cacheable and not errors else {}
+    diagnostics = split_report(workspace, document, settings, batch, result, cacheKeys)
+
+    if cacheKeys:
+        cache_diagnostics(cacheKeys[document.path], diagnostics, settings)
+
+    return diagnostics
+
+
+def execute_check(
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    args: List[str],
+    batch: List[Document],
+    unsaved: Dict[str, str],
+    shadows: List[str],
+    paths: List[str],
+) -> Tuple[Optional[Tuple[str, str, int]], bool]:
+    """
+    Run mypy or dmypy the way the settings select.
+
+    Parameters
+    ----------
+    workspace : Workspace
+        The pylsp workspace.
+    document : Document
+        The document to be linted.
+    settings : Dict[str, Any]
+        The plugin settings.
+    args : List[str]
+        The mypy command-line arguments.
+    batch : List[Document]
+        The documents checked together, including document.
+    unsaved : Dict[str, str]
+        The unsaved sources of the documents of the batch to be checked with them, by path.
+    shadows : List[str]
+        The live mode shadow files among the arguments.
+    paths : List[str]
+        The files to be checked among the arguments.
+
+    Returns
+    -------
+    Tuple[Optional[Tuple[str, str, int]], bool]
+        The report, the errors and the exit status, like mypy_api.run, or None if the previous
+        diagnostics are to be kept, and whether the result may be cached.
+
+    """
+    executor = settings.get("executor", "inprocess")
+    if settings.get("dmypy", False):
+        statusFile = get_status_file(workspace.root_path, settings)
+        touch_daemon(statusFile, settings)
+        wait_for_warm_up(statusFile)
+        log.info("dmypy run args = %s status file = %s", args, statusFile)
+        result = recheck_dmypy(workspace.root_path, statusFile, args, paths, settings)
+        # Checked with the previous options, until the restarted daemon is ready.
+        cacheable = not is_stale(statusFile)
+        if not cacheable:
+            log.info("dmypy daemon %s is stale, not caching its results", statusFile)
+        if result is None:
+            # Report an outage once, instead of with every check while it lasts.
+            outage = report_outage(statusFile)
+            if outage is not None:
+                result = "", f"dmypy is unavailable: {outage}", 2
+        return result, cacheable
+    if settings.get("in_memory", False) and unsaved:
+        log.info("executing mypy args = %s in memory", args)
+        return run_in_memory(args, unsaved), True
+    if executor == "fine_grained":
+        log.info("executing mypy args = %s fine-grained in process", args)
+        excluded = {d.path for d in batch} | set(shadows) | {"--shadow-file"}
+        optionArgs = [arg for arg in args if arg not in excluded]
+        return run_fine_grained(workspace.root_path, args, optionArgs), True
+    if executor == "zygote":
+        log.info("executing mypy args = %s in a process forked from the zygote", args)
+        return run_in_zygote(args, document.path), True
+    if executor == "pool":
+        log.info("executing mypy args = %s in a worker process", args)
+        return run_in_worker(args, document.path, settings), True
+    log.info("executing mypy args = %s via api", args)
+    return mypy_api.run(args), True
+
+
+def split_report(
+    workspace: Workspace,
+    document: Document,
+    settings: Dict[str, Any],
+    batch: List[Document],
+    result: Tuple[str, str, int],
+    cacheKeys: Dict[str, str],
+) -> List[Dict[str, Any]]:
+    """
+    Turn a mypy report into the diagnostics of a document and publish those of other documents.
+
+    Parameters
+    ----------
+    workspace : Workspace
+        The pylsp workspace.
+    document : Document
+        The document being linted.
+    settings : Dict[str, Any]
+        The plugin settings.
+    batch : List[Document]
+        The documents checked together, including document.
+    result : Tuple[str, str, int]
+        The report, the errors and the exit status, like mypy_api.run.
+    cacheKeys : Dict[str, str]
+        The cache keys of the documents of the batch, empty if the result is not to be cached.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        List of the linting data of the document.
+
+    """
+    report, errors, exit_status = result
+    overlay = settings.get("dmypy", False) and settings.get("dmypy_live_mode", False)
     diagnostics = []
 
     # Expose generic mypy error on the first line.
@@ -265,17 +2324,121 @@ def get_diagnostics(
             }
         )
 
+    batchPaths = {d.path for d in batch if d is not document}
+    otherFiles: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
     for line in report.splitlines():
         log.debug("parsing: line = %r", line)
-        diag = parse_line(line, document)
-        if diag:
+        parsed = parse_report_line(line)
+        if not parsed:
+            continue
+        file_path, diag = parsed
+        if overlay:
+            file_path = from_overlay(workspace.root_path, file_path)
+        if file_path != "<string>" and os.path.abspath(file_path) in batchPaths:
+            otherFiles[os.path.abspath(file_path)].append(diag)
+        elif file_path == "<string>" or document.path.endswith(file_path):
             diagnostics.append(diag)
+        else:
+            otherFiles[os.path.abspath(file_path)].append(diag)
 
     log.info("pylsp-mypy len(diagnostics) = %s", len(diagnostics))
 
+    # The other documents of a batch were checked with their unsaved contents.
+    for d in batch:
+        if d is not document:
+            batchDiagnostics = otherFiles.pop(d.path, [])
+            publish_document(workspace, d, batchDiagnostics)
+            if cacheKeys:
+                cache_diagnostics(cacheKeys[d.path], batchDiagnostics, settings)
+
+    if settings.get("publish_related", False):
+        publish_related(workspace, document, otherFiles)
+    elif otherFiles:
+        log.info("discarding results for %s against %s", sorted(otherFiles), document.path)
+
     return diagnostics
 
 
+def publish_related(
+    workspace: Workspace, document: Document, diagnosticsByFile: Dict[str, List[Dict[str, Any]]]
+) -> None:
+    """
+    Publish the diagnostics a check of a document reported for other open documents.
+
+    mypy checked those files as they are on disk, so only documents without unsaved changes are
+    updated. Documents that the previous check of the document reported on, but this one did not,
+    are cleared.
+
+    Parameters
+    ----------
+    workspace : Workspace
+        The pylsp workspace.
+    document : Document
+        The document that was linted.
+    diagnosticsByFile : Dict[str, List[Dict[str, Any]]]
+        The diagnostics of other files by their absolute path.
+
+    """
+    previous = relatedFiles.get(document.path, set())
+    relatedFiles[document.path] = set(diagnosticsByFile)
+
+    for other in list(workspace.documents.values()):
+        if not isinstance(other, Document) or other.path == document.path:
+            continue
+        if other.path not in diagnosticsByFile and other.path not in previous:
+            continue
+        try:
+            with open(other.path, encoding="utf-8") as file:
+                if file.read() != other.source:
+                    log.info("not publishing results for %s, it has unsaved changes", other.path)
+                    continue
+        except OSError:
+            continue
+
+        publish_document(workspace, other, diagnosticsByFile.get(other.path, []))
+
+
+def publish_document(
+    workspace: Workspace, document: Document, diagnostics: List[Dict[str, Any]]
+) -> None:
+    """Publish diagnostics for a document other than the one being linted."""
+    log.info("publishing %s diagnostics for %s", len(diagnostics), document.path)
+    last_diagnostics[document.path] = diagnostics
+    workspace.publish_diagnostics(document.uri, diagnostics, document.version)
+
+
+def dirty_documents(workspace: Workspace, document: Document) -> List[Document]:
+    """Return the open documents of the workspace, except document, with unsaved changes."""
+    dirty = []
+    for other in list(workspace.documents.values()):
+        if not isinstance(other, Document) or other.path == document.path:
+            continue
+        try:
+            with open(other.path, encoding="utf-8") as file:
+                if file.read() == other.source:
+                    continue
+        except OSError:
+            continue
+        dirty.append(other)
+    return dirty
+
+
+@hookimpl
+def pylsp_document_did_save(config: Config, workspace: Workspace, document: Document) -> None:
+    """Forget cached diagnostics and tell the dmypy daemons and their caches about a save."""
+    # Any cached result may depend on the saved file.
+    with cacheLock:
+        diagnosticsCache.clear()
+    with dmypyLock:
+        for statusFile in dmypyDaemons.values():
+            dmypyChanges[statusFile].add(document.path)
+
+    settings = config.plugin_settings("pylsp_mypy", document_path=document.path)
+    if settings.get("dmypy", False) and settings.get("dmypy_fine_grained_cache", False):
+        delay = settings.get("dmypy_fine_grained_cache_delay", 30.0)
+        refresh_fine_grained_cache(workspace.root_path, settings, delay)
+
+
 @hookimpl
 def pylsp_settings(config: Config) -> Dict[str, Dict[str, Dict[str, str]]]:
     """
@@ -306,6 +2469,15 @@ def pylsp_hover(
     settings = settingsCache.get(workspace.root_path, {})
     dmypy = settings.get("dmypy", False)
 
+    statusFile = None
+    if dmypy:
+        key = (workspace.root_path, mypyConfigFileMap.get(workspace.root_path))
+        with dmypyLock:
+            statusFile = dmypyDaemons.get(key)
+        cached = get_cached_hover(statusFile, document, position) if statusFile else None
+        if cached is not None:
+            return cached
+
     try:
         word, base = get_base_hover(document, position)
     except Exception:
@@ -317,20 +2489,43 @@ def pylsp_hover(
     line = position.get("line", 0) + 1
     column = position.get("character", 0) + 1
 
-    global statusFile
-    stdout, stderr, status = mypy_api.run_dmypy(
-        [
-            "--status-file",
-            statusFile,
-            "inspect",
-            "--include-span",
-            "--include-object-attrs",
-            "--union-attrs",
-            "--limit=1",
-            "--show=type",
-            f"{document.path}:{line}:{column}",
-        ]
+    if statusFile is None or not os.path.exists(statusFile) or statusFile in dmypyOutages:
+        # No daemon is running for this workspace, hovering does not start one
+        return format_hover(base, {})
+    touch_daemon(statusFile, settings)
+
+    path = document.path
+    if settings.get("dmypy_live_mode", False):
+        path = to_overlay(workspace.root_path, path)
+
+    # Checks export types from now on. Until one did, the daemon reloads the file to find them.
+    with dmypyLock:
+        dmypyHovers[statusFile] = time.monotonic()
+        forceReload = path not in dmypyTypedFiles.get(statusFile, set())
+
+    response = dmypy_request(
+        statusFile,
+        "inspect",
+        DMYPY_HOVER_TIMEOUT,
+        show="type",
+        location=f"{path}:{line}:{column}",
+        verbosity=0,
+        limit=1,
+        include_span=True,
+        include_kind=False,
+        include_object_attrs=True,
+        union_attrs=True,
+        force_reload=forceReload,
     )
+    if response.get("busy"):
+        # A check is running, the daemon could not answer before it is done anyway.
+        return format_hover(base, {})
+    if "error" in response:
+        stdout, stderr, status = "", response["error"], 2
+    else:
+        stdout, stderr, status = response["out"], response["err"], response["status"]
+        if forceReload and status == 0:
+            record_typed_files(statusFile, [path], True)
 
     if status != 0:
         if stderr:
@@ -356,7 +2551,7 @@ def pylsp_hover(
     else:
         msg = f"```python\n{word}: {msg}\n```\n"
 
-    return format_hover(
+    hover = format_hover(
         base,
         {
             "contents": msg,
@@ -366,6 +2561,57 @@ def pylsp_hover(
             },
         },
     )
+    cache_hover(statusFile, document, position, hover)
+    return hover
+
+
+def word_start(document: Document, position: Dict[str, int]) -> Tuple[int, int]:
+    """Return where the word at a position starts, or the position if it is not on a word."""
+    line = position.get("line", 0)
+    character = position.get("character", 0)
+    lines = document.lines
+    if line < len(lines):
+        character -= len(RE_START_WORD.findall(lines[line][:character])[0])
+    return line, character
+
+
+def get_cached_hover(
+    statusFile: str, document: Document, position: Dict[str, int]
+) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached hover of a position, if the same word was hovered since the last check.
+
+    The inspection answers with the span of the innermost expression at the position, which may
+    contain other expressions. So a hover is only reused within its span and on the same word,
+    where the innermost expression is the same. Editing the document or any check drops the hovers.
+
+    """
+    start = word_start(document, position)
+    point = (position.get("line", 0), position.get("character", 0))
+    with dmypyLock:
+        cached = hoverCache.get(statusFile, {}).get(document.uri)
+        if cached is None or cached[0] != (document.version, document.source):
+            return None
+        for span, spanStart, hover in cached[1]:
+            if spanStart == start and span[:2] <= point <= span[2:]:
+                return hover
+    return None
+
+
+def cache_hover(
+    statusFile: str, document: Document, position: Dict[str, int], hover: Dict[str, Any]
+) -> None:
+    """Cache the hover of a position, which is valid within its range, see get_cached_hover."""
+    start, end = hover["range"]["start"], hover["range"]["end"]
+    span = (start["line"], start["character"], end["line"], end["character"])
+    version = (document.version, document.source)
+    with dmypyLock:
+        documents = hoverCache.setdefault(statusFile, {})
+        cached = documents.get(document.uri)
+        if cached is None or cached[0] != version:
+            cached = documents[document.uri] = (version, [])
+        cached[1].append((span, word_start(document, position), hover))
+        del cached[1][:-HOVER_CACHE_SIZE]
 
 
 def format_hover(base: str, mypy: dict[str, Any]) -> dict[str, Any]:
@@ -463,6 +2709,13 @@ def init(workspace: str) -> Dict[str, str]:
     mypyConfigFileMap[workspace] = mypyConfigFile
     settingsCache[workspace] = configuration.copy()
 
+    if configuration.get("executor") == "zygote":
+        get_zygote_context()
+    if configuration.get("dmypy", False) and configuration.get("dmypy_warm_up", True):
+        warm_up_daemon(workspace, configuration)
+    if configuration.get("dmypy", False) and configuration.get("dmypy_fine_grained_cache", False):
+        refresh_fine_grained_cache(workspace, configuration)
+
     log.info("mypyConfigFile = %s configuration = %s", mypyConfigFile, configuration)
     return configuration
 
@@ -536,20 +2789,26 @@ def findConfigFile(
 
 @atexit.register
 def close() -> None:
-    mypy_api.run_dmypy(["stop"])
-
-    if tmpFile and tmpFile.name:
-        os.unlink(tmpFile.name)
-
-    if os.path.exists(statusFile):
-        with open(statusFile, "rb") as fp:
-            data = json.load(fp)
-            sock = data.get("connection_name")
-
-            try:
-                os.unlink(sock)
-                os.rmdir(os.path.dirname(sock))
-            except Exception:
-                pass
-
-        os.unlink(statusFile)
+    if not settingsCache:
+        # Nothing was set up in this process, like in the mypy worker processes
+        return
+
+    with workerCondition:
+        for process, connection in idleWorkers:
+            connection.close()
+            process.terminate()
+        idleWorkers.clear()
+
+    # Daemons with an idle timeout stop on their own, until then a restarted pylsp reuses them.
+    with dmypyLock:
+        statusFiles = [f for f in dmypyDaemons.values() if f not in dmypyLastUsed]
+        statusFiles.extend(standby_status_file(f) for f in dmypyStandbys)
+        dmypyDaemons.clear()
+    for statusFile in statusFiles:
+        stop_daemon(statusFile)
+
+    if shadowDir:
+        shutil.rmtree(shadowDir, ignore_errors=True)
+
+    if persistentStore is not None:
+        persistentStore.close()
@@ -1,8 +1,15 @@
 import collections
+import json
 import os
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict
 from unittest.mock import Mock
 
@@ -77,6 +84,36 @@ def test_plugin(workspace, last_diagnostics_monkeypatch):
     assert diag["code"] == "attr-defined"
 
 
+def test_plugin_in_memory(workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "shadowFiles", {})
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR)
+    diags = plugin.get_diagnostics(workspace, doc, {"in_memory": True}, is_saved=False)
+
+    assert len(diags) == 1
+    assert diags[0]["range"]["start"] == {"line": 0, "character": 0}
+    assert diags[0]["code"] == "attr-defined"
+    assert plugin.shadowFiles == {}
+
+
+def test_run_in_memory_without_closing_metastore(tmpdir, monkeypatch):
+    from mypy import build
+
+    realBuild = build.build
+
+    def build_without_close(*args, **kwargs):
+        realBuild(*args, **kwargs).manager.metastore.close()
+        # Like mypy before 1.20, whose metadata stores cannot be closed.
+        return SimpleNamespace(manager=SimpleNamespace(metastore=object()))
+
+    monkeypatch.setattr(build, "build", build_without_close)
+    path = str(tmpdir / "a.py")
+    Path(path).write_text("x = 1\n")
+    report, errors, exit_status = plugin.run_in_memory(
+        ["--cache-dir", str(tmpdir / "cache"), path], {path: "x: str = 1\n"}
+    )
+    assert "[assignment]" in report and exit_status == 1
+
+
 def test_parse_full_line(workspace):
     diag = plugin.parse_line(TEST_LINE)  # TODO parse a document here
     assert diag["message"] == '"Request" has no attribute "id"'
@@ -263,6 +300,76 @@ def test_dmypy_status_file(tmpdir, last_diagnostics_monkeypatch, workspace):
         mypy_api.run_dmypy(["--status-file", str(statusFile), "stop"])
 
 
+def test_dmypy_daemons(monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "mypyConfigFileMap", {"/a": None, "/b": "/b/mypy.ini", "/c": None})
+    stop = Mock()
+    monkeypatch.setattr(plugin, "stop_daemon", stop)
+    settings = {"dmypy_max_daemons": 2}
+
+    a = plugin.get_status_file("/a", settings)
+    b = plugin.get_status_file("/b", settings)
+    assert a != b
+    assert plugin.get_status_file("/a", settings) == a
+    assert not stop.called
+
+    # The least recently used daemon is stopped to make room.
+    c = plugin.get_status_file("/c", settings)
+    stop.assert_called_once_with(b)
+    assert list(plugin.dmypyDaemons.values()) == [a, c]
+
+    # A different mypy config file gets a daemon of its own.
+    plugin.mypyConfigFileMap["/a"] = "/a/mypy.ini"
+    assert plugin.get_status_file("/a", settings) not in (a, c)
+
+
+def test_default_status_file(tmpdir, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmpdir))
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict())
+    monkeypatch.setitem(plugin.mypyConfigFileMap, "/ws", None)
+
+    statusFile = plugin.default_status_file("/ws", None)
+    assert statusFile == plugin.default_status_file("/ws", None)
+    assert statusFile != plugin.default_status_file("/ws", "/ws/mypy.ini")
+    assert os.path.dirname(statusFile) == str(tmpdir / "pylsp-mypy")
+
+    # The status file of a dead daemon is cleaned up when it is taken into use.
+    sockDir = tmpdir.mkdir("sock")
+    sockDir.chmod(0o700)
+    sock = sockDir / "dmypy.sock"
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(str(sock))
+    server.close()
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    Path(statusFile).write_text(f'{{"pid": {process.pid}, "connection_name": "{sock}"}}')
+    assert plugin.get_status_file("/ws", {}) == statusFile
+    assert not os.path.exists(statusFile) and not sockDir.exists()
+
+    # Nothing is removed outside of a private directory of the daemon.
+    other = tmpdir.mkdir("other").join("file")
+    other.write("")
+    Path(statusFile).write_text(f'{{"pid": {process.pid}, "connection_name": "{other}"}}')
+    plugin.remove_daemon_files(statusFile)
+    assert not os.path.exists(statusFile) and other.exists()
+
+
+def test_default_status_file_not_private(tmpdir, monkeypatch):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    monkeypatch.setattr(plugin, "shadowDir", str(tmpdir.mkdir("shadow")))
+    directory = tmpdir.mkdir(f"pylsp-mypy-{os.getuid()}")
+
+    # A directory others can write to may have been prepared by them.
+    directory.chmod(0o777)
+    statusFile = plugin.default_status_file("/ws", None)
+    assert os.path.dirname(statusFile) == str(tmpdir / "shadow")
+
+    directory.chmod(0o700)
+    statusFile = plugin.default_status_file("/ws", None)
+    assert os.path.dirname(statusFile) == str(directory)
+
+
 def test_config_sub_paths(tmpdir, last_diagnostics_monkeypatch):
     DOC_SOURCE = """
 def foo():
@@ -328,3 +435,833 @@ def foo():
     diag = diags[0]
     assert diag["message"] == DOC_ERR_MSG
     assert diag["code"] == "unreachable"
+
+
+def test_debounce(monkeypatch):
+    monkeypatch.setattr(plugin, "lintDurations", {})
+    monkeypatch.setattr(plugin, "lintGenerations", collections.defaultdict(int))
+
+    # Without any recorded run there is nothing to wait for.
+    assert plugin.debounce("/ws", "/ws/a.py", {})
+
+    plugin.record_duration("/ws", 1.0)
+    plugin.record_duration("/ws", 0.0)
+    assert plugin.lintDurations["/ws"] == pytest.approx(1 - plugin.DEBOUNCE_SMOOTHING)
+
+    # A request that is followed by a newer one while waiting is superseded.
+    results = []
+    thread = threading.Thread(target=lambda: results.append(plugin.debounce("/ws", "/ws/a.py", {})))
+    thread.start()
+    while plugin.lintGenerations["/ws/a.py"] < 2:
+        pass
+    assert plugin.debounce("/ws", "/ws/a.py", {"debounce_max_delay": 0})
+    thread.join()
+    assert results == [False]
+
+
+def test_schedule_check_discards_outdated(workspace, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def get_diagnostics(workspace, document, settings, is_saved, lookup):
+        started.set()
+        release.wait()
+        return [{"version": document.version}]
+
+    monkeypatch.setattr(plugin, "get_diagnostics", get_diagnostics)
+    monkeypatch.setattr(plugin, "inFlight", {})
+
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR, version=1)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(plugin.schedule_check(workspace, doc, {}, False))
+    )
+    thread.start()
+    started.wait()
+
+    # The document moves on while the first check is still running.
+    doc.version = 2
+    release.set()
+    thread.join()
+    assert results == [None]
+
+    assert plugin.schedule_check(workspace, doc, {}, False) == [{"version": 2}]
+    assert plugin.inFlight == {}
+
+
+def test_schedule_check_retries_failed(workspace, monkeypatch):
+    get_diagnostics = Mock(side_effect=[OSError("boom"), []])
+    monkeypatch.setattr(plugin, "get_diagnostics", get_diagnostics)
+    monkeypatch.setattr(plugin, "inFlight", {})
+
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR, version=1)
+    with pytest.raises(OSError):
+        plugin.schedule_check(workspace, doc, {}, False)
+    assert plugin.inFlight == {}
+
+    # The same version is checked again instead of reusing the failed check.
+    assert plugin.schedule_check(workspace, doc, {}, False) == []
+    assert get_diagnostics.call_count == 2
+
+
+def test_schedule_check_without_lookup(workspace, monkeypatch):
+    get_diagnostics = Mock(return_value=[])
+    monkeypatch.setattr(plugin, "get_diagnostics", get_diagnostics)
+    monkeypatch.setattr(plugin, "inFlight", {})
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR, version=2)
+
+    # A newer version is being checked, it is neither cancelled nor checked again.
+    newer: Future = Future()
+    plugin.inFlight[doc.path] = ((3, False), newer)
+    assert plugin.schedule_check(workspace, doc, {}, False, lookup=False) is None
+    assert plugin.inFlight[doc.path][1] is newer
+    get_diagnostics.assert_not_called()
+
+    # The check of the same version is not shared, the document is checked after it.
+    checked: Future = Future()
+    checked.set_result([{"cached": True}])
+    plugin.inFlight[doc.path] = ((2, False), checked)
+    assert plugin.schedule_check(workspace, doc, {}, False, lookup=False) == []
+    get_diagnostics.assert_called_once_with(workspace, doc, {}, False, False)
+    assert plugin.inFlight == {}
+
+
+def test_diagnostics_cache(workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "cacheStats", {"hits": 0, "misses": 0})
+    monkeypatch.setattr(plugin, "revalidations", {})
+    monkeypatch.setattr(plugin, "inFlight", {})
+    monkeypatch.setattr(plugin, "last_diagnostics", collections.defaultdict(list))
+    run = Mock(return_value=(TEST_LINE.replace("test_plugin.py", DOC_URI[6:]), "", 1))
+    monkeypatch.setattr(plugin.mypy_api, "run", run)
+    publish = Mock()
+    monkeypatch.setattr(workspace, "publish_diagnostics", publish)
+
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR, version=1)
+    first = plugin.get_diagnostics(workspace, doc, {}, is_saved=False)
+    second = plugin.get_diagnostics(workspace, doc, {}, is_saved=False)
+
+    assert first == second
+    assert plugin.cacheStats == {"hits": 1, "misses": 1}
+
+    # A hit is checked again in the background, the files it imports may have changed.
+    plugin.revalidations[doc.path].result()
+    assert run.call_count == 2
+    assert doc.path not in plugin.last_diagnostics
+    run.return_value = ("", "", 0)
+    assert plugin.get_diagnostics(workspace, doc, {}, is_saved=False) == first
+    plugin.revalidations[doc.path].result()
+    assert plugin.inFlight == {}
+    # The new result is left for the next lint, publishing it would drop other linters' results.
+    publish.assert_not_called()
+    assert plugin.last_diagnostics[doc.path] == []
+    assert plugin.get_diagnostics(workspace, doc, {}, is_saved=False) == []
+    plugin.revalidations[doc.path].result()
+
+    doc.apply_change({"text": DOC_TYPE_ERR + "\n"})
+    plugin.get_diagnostics(workspace, doc, {}, is_saved=False)
+    assert run.call_count == 5
+
+    plugin.get_diagnostics(workspace, doc, {"cache_size": 0}, is_saved=False)
+    assert run.call_count == 6
+
+    # Saving a document may change the result of any check.
+    plugin.pylsp_document_did_save(workspace._config, workspace, doc)
+    assert not plugin.diagnosticsCache
+
+
+def test_persistent_cache(tmpdir, workspace, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+    monkeypatch.setattr(plugin, "persistentStore", None)
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "revalidations", {})
+    monkeypatch.setattr(plugin, "inFlight", {})
+    run = Mock(return_value=(TEST_LINE.replace("test_plugin.py", DOC_URI[6:]), "", 1))
+    monkeypatch.setattr(plugin.mypy_api, "run", run)
+
+    settings = {"cache_size": 0, "persistent_cache": True, "persistent_cache_size": 1}
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR)
+    first = plugin.get_diagnostics(workspace, doc, settings, is_saved=True)
+    assert tmpdir.join("pylsp-mypy", "diagnostics.sqlite3").exists()
+
+    # A restarted server (or another instance) finds the result on disk.
+    plugin.persistentStore.close()
+    plugin.persistentStore = None
+    assert plugin.get_diagnostics(workspace, doc, settings, is_saved=True) == first
+    plugin.revalidations[doc.path].result()
+    assert run.call_count == 2
+
+    # It is still checked, and replaced if an imported module changed meanwhile.
+    run.return_value = ("", "", 0)
+    assert plugin.get_diagnostics(workspace, doc, settings, is_saved=True) == first
+    plugin.revalidations[doc.path].result()
+    assert plugin.get_diagnostics(workspace, doc, settings, is_saved=True) == []
+    plugin.revalidations[doc.path].result()
+    assert run.call_count == 4
+
+    # Only the most recent result is kept.
+    other = Document(DOC_URI, workspace, DOC_TYPE_ERR + "\n")
+    plugin.get_diagnostics(workspace, other, settings, is_saved=True)
+    plugin.get_diagnostics(workspace, doc, settings, is_saved=True)
+    assert run.call_count == 6
+    plugin.persistentStore.close()
+
+
+def test_diagnostics_cache_key(monkeypatch):
+    def key(overlay, path):
+        return plugin.diagnostics_cache_key("x = 1\n", [f"{overlay}/pkg/{path}"], None, [overlay])
+
+    # The overlay trees of two processes have other names, their files are the same.
+    assert key("/shm/overlay-1", "a.py") == key("/shm/overlay-2", "a.py")
+    assert key("/shm/overlay-1", "a.py") != key("/shm/overlay-1", "b.py")
+
+    # Results of another mypy version are not reused.
+    first = key("/shm/overlay-1", "a.py")
+    monkeypatch.setattr(plugin, "mypy_version", "0.0")
+    assert key("/shm/overlay-1", "a.py") != first
+
+
+def test_shadow_files(tmpdir, workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "shadowDir", str(tmpdir.mkdir("shadow")))
+    monkeypatch.setattr(plugin, "shadowFiles", {})
+
+    workspace.put_document(DOC_URI, DOC_TYPE_ERR)
+    doc = workspace.get_document(DOC_URI)
+    other = Document(uris.from_fs_path(str(tmpdir / "other.py")), workspace, "x = 1\n")
+
+    name = plugin.get_shadow_file(doc, doc.source)
+    assert name != plugin.get_shadow_file(other, other.source)
+    assert Path(name).read_text() == DOC_TYPE_ERR
+
+    # Unchanged sources are not written again.
+    os.unlink(name)
+    assert plugin.get_shadow_file(doc, doc.source) == name
+    assert not os.path.exists(name)
+
+    doc.apply_change({"text": "x = 2\n"})
+    assert plugin.get_shadow_file(doc, doc.source) == name
+    assert Path(name).read_text() == "x = 2\n"
+
+    # other.py was never opened in the workspace, so its shadow file is removed.
+    otherName = plugin.shadowFiles[other.path][0]
+    plugin.prune_shadow_files(workspace)
+    assert list(plugin.shadowFiles) == [doc.path]
+    assert not os.path.exists(otherName)
+
+
+def test_publish_related(tmpdir, workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "relatedFiles", {})
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    other = tmpdir / "other.py"
+    other.write("x: int = ''\n")
+    otherUri = uris.from_fs_path(str(other))
+    workspace.put_document(otherUri, other.read(), version=3)
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR)
+
+    report = f"{other}:1:10:1:11: error: Incompatible types in assignment  [assignment]\n"
+    monkeypatch.setattr(plugin.mypy_api, "run", Mock(return_value=(report, "", 1)))
+
+    assert plugin.get_diagnostics(workspace, doc, {"publish_related": True}, is_saved=True) == []
+    params = workspace._endpoint.notify.call_args[1]["params"]
+    assert params["uri"] == otherUri
+    assert params["version"] == 3
+    assert params["diagnostics"][0]["code"] == "assignment"
+    assert plugin.last_diagnostics[str(other)] == params["diagnostics"]
+
+    # Once fixed the other document is cleared.
+    monkeypatch.setattr(plugin.mypy_api, "run", Mock(return_value=("", "", 0)))
+    doc.apply_change({"text": "x = 1\n"})
+    plugin.get_diagnostics(workspace, doc, {"publish_related": True}, is_saved=True)
+    assert workspace._endpoint.notify.call_args[1]["params"]["diagnostics"] == []
+
+
+def test_batch_dirty(tmpdir, workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "shadowDir", str(tmpdir.mkdir("shadow")))
+    monkeypatch.setattr(plugin, "shadowFiles", {})
+
+    clean = tmpdir / "clean.py"
+    clean.write("x = 1\n")
+    dirty = tmpdir / "dirty.py"
+    dirty.write("y = 1\n")
+    workspace.put_document(uris.from_fs_path(str(clean)), clean.read())
+    workspace.put_document(uris.from_fs_path(str(dirty)), "y: str = 1\n", version=2)
+    workspace.put_document(DOC_URI, DOC_TYPE_ERR)
+    doc = workspace.get_document(DOC_URI)
+
+    report = f"{dirty}:1:10:1:11: error: Incompatible types in assignment  [assignment]\n"
+    run = Mock(return_value=(report, "", 1))
+    monkeypatch.setattr(plugin.mypy_api, "run", run)
+
+    assert plugin.get_diagnostics(workspace, doc, {"batch_dirty": True}, is_saved=False) == []
+    args = run.call_args[0][0]
+    assert args.count("--shadow-file") == 2
+    assert str(dirty) in args and doc.path in args and str(clean) not in args
+
+    params = workspace._endpoint.notify.call_args[1]["params"]
+    assert params["uri"] == uris.from_fs_path(str(dirty))
+    assert params["diagnostics"][0]["code"] == "assignment"
+
+    # Linting the other document of the batch next is answered from the cache.
+    dirtyDoc = workspace.get_document(uris.from_fs_path(str(dirty)))
+    diags = plugin.get_diagnostics(workspace, dirtyDoc, {"batch_dirty": True}, is_saved=False)
+    assert diags == params["diagnostics"]
+    assert run.call_count == 1
+
+
+def test_run_in_worker(monkeypatch):
+    monkeypatch.setattr(plugin, "idleWorkers", [])
+    monkeypatch.setattr(plugin, "workerCount", 0)
+
+    report, errors, exit_status = plugin.run_in_worker(["--version"], "a.py", {})
+    assert report.startswith("mypy ") and exit_status == 0
+    assert len(plugin.idleWorkers) == 1
+
+    # A dead worker is replaced.
+    process = plugin.idleWorkers[0][0]
+    process.kill()
+    process.join()
+    plugin.run_in_worker(["--version"], "a.py", {})
+    assert plugin.idleWorkers[0][0] is not process
+
+    # Workers growing past the limit are retired.
+    plugin.run_in_worker(["--version"], "a.py", {"worker_max_rss": 0})
+    assert plugin.idleWorkers == []
+    assert plugin.workerCount == 0
+
+
+@pytest.mark.skipif(os.name == "nt", reason="There is no zygote on Windows.")
+def test_run_in_zygote():
+    report, errors, exit_status = plugin.run_in_zygote(["--version"], "a.py")
+    assert report.startswith("mypy ") and exit_status == 0
+    assert plugin.busyWorkers == {}
+
+
+def test_run_fine_grained(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "fineGrainedEngines", {})
+    lib = tmpdir / "lib.py"
+    lib.write("def f() -> int:\n    return 1\n")
+    main = tmpdir / "main.py"
+    main.write("from lib import f\nx: int = f()\n")
+    shadow = tmpdir / "shadow.py"
+    optionArgs = ["--show-error-end", "--no-error-summary", "--follow-imports", "silent"]
+    monkeypatch.chdir(tmpdir)
+
+    def check(source):
+        shadow.write(source)
+        args = optionArgs + ["--shadow-file", str(main), str(shadow), str(main)]
+        return plugin.run_fine_grained(str(tmpdir), args, optionArgs)
+
+    assert check("from lib import f\nx: int = f()\n") == ("", "", 0)
+    engine = plugin.fineGrainedEngines[str(tmpdir)]
+
+    report, errors, exit_status = check("from lib import f\nx: str = f()\n")
+    assert "main.py:2:" in report and "[assignment]" in report and exit_status == 1
+    assert plugin.fineGrainedEngines[str(tmpdir)] is engine
+
+    # Changes on disk to other files are picked up as well.
+    lib.write("def f() -> str:\n    return ''\n")
+    assert check("from lib import f\nx: str = f()\n") == ("", "", 0)
+    assert plugin.fineGrainedEngines[str(tmpdir)] is engine
+
+
+@pytest.mark.skipif(os.name == "nt", reason="The overlay needs symbolic links.")
+def test_dmypy_live_mode(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "shadowDir", str(tmpdir.mkdir("shadow")))
+    monkeypatch.setattr(plugin, "overlayDirs", {})
+    monkeypatch.setattr(plugin, "overlayFiles", {})
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict())
+    root = tmpdir.mkdir("root")
+    workspace = Workspace(uris.from_fs_path(str(root)), Mock())
+    pkg = root.mkdir("pkg")
+    pkg.join("__init__.py").write("")
+    pkg.join("lib.py").write("def f() -> int:\n    return 1\n")
+    main = pkg / "main.py"
+    main.write("from pkg.lib import f\nx: int = f()\n")
+    uri = uris.from_fs_path(str(main))
+    workspace.put_document(uri, main.read())
+    doc = workspace.get_document(uri)
+    settings = {"dmypy": True, "dmypy_live_mode": True, "cache_size": 0}
+
+    try:
+        assert plugin.get_diagnostics(workspace, doc, settings, is_saved=True) == []
+        overlay = plugin.overlayDirs[str(root)]
+        assert os.path.islink(os.path.join(overlay, "pkg", "main.py"))
+
+        # The unsaved source is checked and reported against the document.
+        doc.apply_change({"text": "from pkg.lib import f\nx: str = f()\n"})
+        diags = plugin.get_diagnostics(workspace, doc, settings, is_saved=False)
+        assert [diag["code"] for diag in diags] == ["assignment"]
+        assert Path(overlay, "pkg", "main.py").read_text() == doc.source
+        assert main.read() == "from pkg.lib import f\nx: int = f()\n"
+
+        # A rewrite of the same size within the same second is seen as well.
+        doc.apply_change({"text": "from pkg.lib import f\nx: int = f()\n"})
+        assert plugin.get_diagnostics(workspace, doc, settings, is_saved=False) == []
+        doc.apply_change({"text": "from pkg.lib import f\nx: str = f()\n"})
+        diags = plugin.get_diagnostics(workspace, doc, settings, is_saved=False)
+        assert [diag["code"] for diag in diags] == ["assignment"]
+
+        # Changes to other files on disk are seen through the links.
+        pkg.join("lib.py").write("def f() -> str:\n    return ''\n")
+        assert plugin.get_diagnostics(workspace, doc, settings, is_saved=False) == []
+    finally:
+        plugin.stop_daemon(plugin.dmypyDaemons[(str(root), None)])
+
+
+def test_overlay_same_size_edit(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "shadowDir", str(tmpdir.mkdir("shadow")))
+    monkeypatch.setattr(plugin, "overlayDirs", {})
+    monkeypatch.setattr(plugin, "overlayFiles", {})
+    root = tmpdir.mkdir("root")
+    main = root.join("main.py")
+    main.write("x: int = 1\n")
+
+    target = plugin.get_overlay_path(str(root), str(main), "x: str = 1\n")
+    first = os.stat(target).st_mtime_ns
+    assert first >= os.stat(str(main)).st_mtime_ns + 1_000_000_000
+
+    # Unchanged sources are not rewritten, edits of the same size move the mtime by a second.
+    assert plugin.get_overlay_path(str(root), str(main), "x: str = 1\n") == target
+    assert os.stat(target).st_mtime_ns == first
+    plugin.get_overlay_path(str(root), str(main), "x: int = 1\n")
+    assert os.stat(target).st_mtime_ns == first + 1_000_000_000
+    assert plugin.overlayFiles[str(main)][1] == first + 1_000_000_000
+
+
+def test_dmypy_request(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    monkeypatch.setattr(plugin, "dmypyHovers", {statusFile: time.monotonic()})
+    source = tmpdir / "a.py"
+    source.write("x: int = ''\n")
+
+    # Nothing to connect to yet.
+    assert "error" in plugin.dmypy_request(statusFile, "status")
+
+    try:
+        report, errors, exit_status = plugin.run_dmypy(statusFile, [str(source)], [str(source)], {})
+        assert "[assignment]" in report and exit_status == 1
+
+        # Once started the daemon is asked directly.
+        run = Mock(side_effect=AssertionError)
+        monkeypatch.setattr(plugin.mypy_api, "run_dmypy", run)
+        report, errors, exit_status = plugin.run_dmypy(statusFile, [str(source)], [str(source)], {})
+        assert "[assignment]" in report and exit_status == 1
+        assert statusFile in plugin.dmypyConnections
+
+        response = plugin.dmypy_request(
+            statusFile,
+            "inspect",
+            show="type",
+            location=f"{source}:1:1",
+            limit=1,
+            include_span=True,
+        )
+        assert response["status"] == 0 and response["out"].strip() == '1:1:1:1 -> "int"'
+    finally:
+        monkeypatch.undo()
+        plugin.stop_daemon(statusFile)
+
+
+def test_dmypy_request_timeout(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    statusFile = tmpdir / ".dmypy.json"
+    statusFile.write(json.dumps({"pid": os.getpid(), "connection_name": str(tmpdir / "sock")}))
+    client = Mock(side_effect=socket.timeout("timed out"))
+    monkeypatch.setattr("mypy.ipc.IPCClient", client)
+
+    # Older Pythons raise socket.timeout, which is not a TimeoutError yet.
+    response = plugin.dmypy_request(str(statusFile), "run", 1.0)
+    assert response["hung"] and "within 1.0s" in response["error"]
+
+
+def test_dmypy_request_busy(tmpdir, workspace, monkeypatch):
+    statusFile = str(tmpdir / ".dmypy.json")
+    Path(statusFile).touch()
+    key = (workspace.root_path, plugin.mypyConfigFileMap.get(workspace.root_path))
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict({key: statusFile}))
+    monkeypatch.setattr(plugin, "dmypyRequestLocks", collections.defaultdict(threading.RLock))
+    monkeypatch.setattr(plugin, "hoverCache", {})
+    monkeypatch.setattr(plugin, "DMYPY_HOVER_TIMEOUT", 0.1)
+    monkeypatch.setitem(plugin.settingsCache, workspace.root_path, {"dmypy": True})
+    doc = Document(DOC_URI, workspace, "number = 1\n", version=1)
+
+    # Another thread is in the middle of a request to the daemon.
+    acquired, release = threading.Event(), threading.Event()
+
+    def hold():
+        with plugin.dmypyRequestLocks[statusFile]:
+            acquired.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    acquired.wait()
+    try:
+        response = plugin.dmypy_request(statusFile, "status", 0.1)
+        assert response["busy"] and "error" in response
+
+        # Hovering falls back to jedi alone.
+        position = {"line": 0, "character": 0}
+        hover = plugin.pylsp_hover(doc._config, workspace, doc, position)
+        assert hover == {"contents": plugin.get_base_hover(doc, position)[1]}
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_dmypy_restart_without_timeout(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyOptions", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    request = Mock(side_effect=[{"error": "not running"}, {"out": "", "err": "", "status": 0}])
+    monkeypatch.setattr(plugin, "dmypy_request", request)
+    monkeypatch.setattr(plugin, "claim_daemon", lambda statusFile: True)
+    monkeypatch.setattr(plugin.mypy_api, "run_dmypy", Mock(return_value=("", "", 0)))
+
+    # Only the first check of the new daemon may take longer than the timeout.
+    assert plugin.run_dmypy(statusFile, ["a.py"], ["a.py"], {"dmypy_timeout": 5}) == ("", "", 0)
+    assert [call[0][2] for call in request.call_args_list] == [5, None]
+
+
+def test_export_types(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyHovers", {})
+    monkeypatch.setattr(plugin, "dmypyTypedFiles", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    source = tmpdir / "a.py"
+    source.write("x: int = 1\n")
+    args = [str(source)]
+
+    def inspect(forceReload):
+        location = f"{source}:1:1"
+        response = plugin.dmypy_request(
+            statusFile, "inspect", show="type", location=location, force_reload=forceReload
+        )
+        return response["out"].strip()
+
+    try:
+        # Nobody hovered yet, the daemon does not keep the types around.
+        assert not plugin.exports_types(statusFile, {})
+        plugin.run_dmypy(statusFile, args, args, {})
+        assert statusFile not in plugin.dmypyTypedFiles
+        assert "No known type" in inspect(False)
+        assert inspect(True) == '"int"'
+
+        # Once hovered, checks export types.
+        plugin.dmypyHovers[statusFile] = time.monotonic()
+        assert plugin.exports_types(statusFile, {})
+        plugin.run_dmypy(statusFile, args, args, {})
+        assert plugin.dmypyTypedFiles[statusFile] == {str(source)}
+        assert inspect(False) == '"int"'
+
+        # Until hovering is idle again.
+        settings = {"dmypy_hover_idle_timeout": 0}
+        assert not plugin.exports_types(statusFile, settings)
+        plugin.run_dmypy(statusFile, args, args, settings)
+        assert statusFile not in plugin.dmypyTypedFiles
+    finally:
+        monkeypatch.undo()
+        plugin.stop_daemon(statusFile)
+
+
+def test_standby_daemon(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyOptions", {})
+    monkeypatch.setattr(plugin, "dmypyStandbys", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    standby = plugin.standby_status_file(statusFile)
+    assert standby == str(tmpdir / ".dmypy.standby.json")
+    assert plugin.standby_status_file(standby) == statusFile
+    key = (str(tmpdir), None)
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict({key: statusFile}))
+    source = tmpdir / "a.py"
+    source.write("def f(x):\n    return x\n")
+    paths = [str(source)]
+
+    try:
+        assert plugin.run_dmypy(statusFile, paths, paths, {})[2] == 0
+
+        # With other options the daemon keeps checking with its own, while a standby starts.
+        report, errors, exit_status = plugin.run_dmypy(statusFile, ["--strict"] + paths, paths, {})
+        assert exit_status == 0 and plugin.is_stale(statusFile)
+        plugin.dmypyStandbys[statusFile].result()
+
+        # Once the standby checked, it replaces the daemon.
+        assert not plugin.is_stale(statusFile)
+        assert plugin.dmypyDaemons[key] == standby
+        assert not os.path.exists(statusFile)
+        monkeypatch.setattr(plugin.mypy_api, "run_dmypy", Mock(side_effect=AssertionError))
+        report, errors, exit_status = plugin.run_dmypy(standby, ["--strict"] + paths, paths, {})
+        assert "[no-untyped-def]" in report and exit_status == 1
+    finally:
+        monkeypatch.undo()
+        plugin.stop_daemon(statusFile)
+        plugin.stop_daemon(standby)
+
+
+def test_hover_cache(tmpdir, workspace, monkeypatch):
+    statusFile = str(tmpdir / ".dmypy.json")
+    Path(statusFile).touch()
+    key = (workspace.root_path, plugin.mypyConfigFileMap.get(workspace.root_path))
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict({key: statusFile}))
+    monkeypatch.setattr(plugin, "hoverCache", {})
+    monkeypatch.setattr(plugin, "dmypyHovers", {})
+    monkeypatch.setattr(plugin, "dmypyTypedFiles", {})
+    settings = {"dmypy": True, "dmypy_idle_timeout": 0}
+    monkeypatch.setitem(plugin.settingsCache, workspace.root_path, settings)
+    request = Mock(return_value={"out": '1:1:1:6 -> "int"\n', "err": "", "status": 0})
+    monkeypatch.setattr(plugin, "dmypy_request", request)
+    doc = Document(DOC_URI, workspace, "number = 1\n", version=1)
+
+    def hover(character):
+        return plugin.pylsp_hover(doc._config, workspace, doc, {"line": 0, "character": character})
+
+    # Moving over the same word is answered from the cache.
+    first = hover(0)
+    assert "number: int" in first["contents"]
+    assert hover(3) is first and hover(5) is first
+    assert request.call_count == 1
+
+    # Another word in the span may be another expression.
+    hover(9)
+    assert request.call_count == 2
+
+    # Changes to the document and checks drop the cache.
+    doc.apply_change({"text": "number = 2\n"})
+    doc.version = 2
+    hover(0)
+    assert request.call_count == 3
+    plugin.record_typed_files(statusFile, [doc.path], True)
+    hover(0)
+    assert request.call_count == 4
+
+
+def test_dmypy_outage(tmpdir, workspace, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyOutages", {})
+    monkeypatch.setattr(plugin, "reportedOutages", set())
+    monkeypatch.setattr(plugin, "dmypyRuns", {})
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    statusFile = str(tmpdir / ".dmypy.json")
+    monkeypatch.setattr(plugin, "get_status_file", lambda workspace, settings: statusFile)
+    run = Mock(return_value=("", "dmypy: boom", 2))
+    monkeypatch.setattr(plugin.mypy_api, "run_dmypy", run)
+    doc = Document(DOC_URI, workspace, DOC_TYPE_ERR)
+    settings = {"dmypy": True, "dmypy_idle_timeout": 0}
+
+    # The daemon does not start: the outage is reported once, then the old diagnostics are kept.
+    diags = plugin.get_diagnostics(workspace, doc, settings, is_saved=True)
+    assert len(diags) == 1 and "dmypy: boom" in diags[0]["message"]
+    plugin.last_diagnostics[doc.path] = diags
+    assert plugin.get_diagnostics(workspace, doc, settings, is_saved=True) is diags
+    assert run.call_count == 1
+
+    # After the backoff the daemon is tried again, with a longer backoff if it still fails.
+    monkeypatch.setattr(plugin, "DMYPY_BACKOFF_START", 0.0)
+    monkeypatch.setitem(plugin.dmypyOutages, statusFile, (1, 0.0, "dmypy: boom"))
+    assert plugin.recheck_dmypy(str(tmpdir), statusFile, [doc.path], [doc.path], settings) is None
+    assert run.call_count == 2
+    assert plugin.dmypyOutages[statusFile][0] == 2
+
+
+def test_warm_up_daemon(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "dmypyWarmUps", {})
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "diagnosticsCache", collections.OrderedDict())
+    root = tmpdir.mkdir("root")
+    root.join("a.py").write("x: int = ''\n")
+    workspace = Workspace(uris.from_fs_path(str(root)), Mock())
+    uri = uris.from_fs_path(str(root / "a.py"))
+    workspace.put_document(uri, root.join("a.py").read())
+    run = Mock(wraps=mypy_api.run_dmypy)
+    monkeypatch.setattr(plugin.mypy_api, "run_dmypy", run)
+    settings = {"dmypy": True}
+
+    monkeypatch.setitem(plugin.mypyConfigFileMap, str(root), None)
+    plugin.warm_up_daemon(str(root), settings)
+    statusFile = plugin.dmypyDaemons[(str(root), None)]
+    try:
+        # The first lint waits for the warm-up and does not start a daemon of its own.
+        diags = plugin.get_diagnostics(workspace, workspace.get_document(uri), settings, True)
+        assert [diag["code"] for diag in diags] == ["assignment"]
+        assert run.call_count == 1
+        assert "restart" in run.call_args[0][0]
+    finally:
+        plugin.stop_daemon(statusFile)
+
+
+def test_recheck_dmypy(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyRuns", {})
+    monkeypatch.setattr(plugin, "dmypyChanges", collections.defaultdict(set))
+    statusFile = str(tmpdir / ".dmypy.json")
+    lib = tmpdir / "lib.py"
+    lib.write("def f() -> int:\n    return 1\n")
+    main = tmpdir / "main.py"
+    main.write("from lib import f\nx: int = f()\n")
+    monkeypatch.chdir(tmpdir)
+    settings: Dict[str, float] = {}
+
+    def check(*paths):
+        args = ["--follow-imports", "error", *paths]
+        return plugin.recheck_dmypy(str(tmpdir), statusFile, args, list(paths), settings)
+
+    try:
+        assert check(str(main), str(lib))[2] == 0
+        run = Mock(side_effect=AssertionError)
+        monkeypatch.setattr(plugin.mypy_api, "run_dmypy", run)
+
+        # Saved files are passed to the daemon without a full run.
+        lib.write("def f() -> str:\n    return ''\n")
+        plugin.dmypyChanges[statusFile].add(str(lib))
+        report, errors, exit_status = check(str(main))
+        assert "main.py:2:" in report and exit_status == 1
+
+        # A full run is done once the interval passed.
+        settings["dmypy_full_run_interval"] = 0
+        monkeypatch.setattr(plugin.mypy_api, "run_dmypy", mypy_api.run_dmypy)
+        check(str(main))
+        assert plugin.dmypyRuns[statusFile][2]
+    finally:
+        monkeypatch.undo()
+        plugin.stop_daemon(statusFile)
+
+
+def test_refresh_fine_grained_cache(monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyDaemons", collections.OrderedDict())
+    monkeypatch.setattr(plugin, "cacheRefreshes", {})
+    monkeypatch.setattr(plugin, "cacheRefreshPending", set())
+    monkeypatch.setitem(plugin.mypyConfigFileMap, "/ws", None)
+    started = threading.Event()
+    release = threading.Event()
+
+    def run(args, path, settings):
+        started.set()
+        release.wait(5)
+        return "", "", 0
+
+    # mypy runs in a worker process, not in the pylsp process.
+    run = Mock(side_effect=run)
+    monkeypatch.setattr(plugin, "run_in_worker", run)
+    monkeypatch.setattr(plugin, "cacheRefreshDue", {})
+    settings = {"dmypy": True, "dmypy_fine_grained_cache": True}
+
+    assert "--use-fine-grained-cache" in plugin.daemon_args("/ws", settings)[0]
+    plugin.refresh_fine_grained_cache("/ws", settings)
+    assert started.wait(5)
+    # Requests while a refresh runs result in a single further refresh, after the delay.
+    plugin.refresh_fine_grained_cache("/ws", settings, 0.3)
+    plugin.refresh_fine_grained_cache("/ws", settings, 0.3)
+    release.set()
+    time.sleep(0.1)
+    assert run.call_count == 1
+    plugin.cacheRefreshes["/ws"].result(5)
+
+    assert run.call_count == 2
+    args = run.call_args[0][0]
+    assert "--cache-fine-grained" in args and "--use-fine-grained-cache" not in args
+    assert "/ws" in args
+
+
+def test_idle_daemons_are_stopped(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyLastUsed", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    source = tmpdir / "a.py"
+    source.write("x: int = ''\n")
+    args = [str(source)]
+    settings = {"dmypy_idle_timeout": 1}
+
+    plugin.touch_daemon("b.json", {"dmypy_idle_timeout": 0})
+    assert plugin.dmypyLastUsed == {}
+
+    try:
+        # The daemon stops by itself, whichever process used it.
+        plugin.touch_daemon(statusFile, settings)
+        assert plugin.run_dmypy(statusFile, args, args, settings)[2] == 1
+        assert list(plugin.dmypyLastUsed) == [statusFile]
+        deadline = time.monotonic() + 30
+        while os.path.exists(statusFile) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert not os.path.exists(statusFile)
+
+        # The next check starts it again.
+        assert plugin.run_dmypy(statusFile, args, args, settings)[2] == 1
+    finally:
+        plugin.stop_daemon(statusFile)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="Memory is read from /proc.")
+def test_recycle_daemon(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyConnections", {})
+    monkeypatch.setattr(plugin, "dmypyRuns", {})
+    monkeypatch.setattr(plugin, "dmypyRecycling", set())
+    statusFile = str(tmpdir / ".dmypy.json")
+    source = tmpdir / "a.py"
+    source.write("x: int = ''\n")
+    args = [str(source)]
+
+    try:
+        plugin.recheck_dmypy(str(tmpdir), statusFile, args, args, {})
+        pid = plugin.dmypyConnections[statusFile][0]
+        assert plugin.read_rss(str(pid)) > 0
+
+        # A daemon past the limit is replaced by one that repeated the check.
+        stopping = threading.Event()
+        stop_daemon = plugin.stop_daemon
+
+        def stop(statusFile):
+            stopping.set()
+            stop_daemon(statusFile)
+
+        monkeypatch.setattr(plugin, "stop_daemon", stop)
+        result = plugin.recheck_dmypy(str(tmpdir), statusFile, args, args, {"dmypy_max_rss": 1})
+        assert result[2] == 1
+
+        # A request arriving meanwhile waits for the new daemon.
+        assert stopping.wait(60)
+        response = plugin.dmypy_request(statusFile, "recheck", 60, export_types=True)
+        assert "error" not in response
+        assert plugin.dmypyConnections[statusFile][0] != pid
+        assert "[assignment]" in response["out"]
+        while plugin.dmypyRecycling:
+            time.sleep(0.1)
+    finally:
+        plugin.stop_daemon(statusFile)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Daemons are not shared on Windows.")
+def test_shared_daemon(tmpdir, monkeypatch):
+    monkeypatch.setattr(plugin, "dmypyOwned", {})
+    statusFile = str(tmpdir / ".dmypy.json")
+    Path(statusFile).write_text("{}")
+    owner = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import fcntl, os, sys, time\n"
+            f"fd = os.open({statusFile + '.lock'!r}, os.O_RDWR | os.O_CREAT)\n"
+            "fcntl.lockf(fd, fcntl.LOCK_EX)\n"
+            "print(flush=True)\n"
+            "time.sleep(60)\n",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    stop = Mock(return_value=("", "", 0))
+    monkeypatch.setattr(plugin.mypy_api, "run_dmypy", stop)
+    try:
+        owner.stdout.readline()
+        # A client does not stop the daemon of another process.
+        assert not plugin.claim_daemon(statusFile)
+        plugin.stop_daemon(statusFile)
+        assert not stop.called and os.path.exists(statusFile)
+    finally:
+        owner.kill()
+        owner.wait()
+
+    # Once the owner exited the daemon can be taken over.
+    plugin.stop_daemon(statusFile)
+    assert stop.called and not os.path.exists(statusFile)
+    assert plugin.dmypyOwned == {}